@@ -2,7 +2,6 @@ import streamlit as st
 import pandas as pd
 from datetime import datetime, date, timedelta
 import os
-import json
 import requests
 from streamlit_lottie import st_lottie
 import smtplib
@@ -18,16 +17,13 @@ import io
 # ==========================================
 # นำเข้าโมดูลจากไฟล์ที่แยกออกไป
 # ==========================================
-from database import load_data, save_data, generate_doc_no, to_int, CUST_FILE, PROD_FILE, HISTORY_FILE
-from pdf_generator import create_pdf, convert_pdf_to_image
-
-# --- ฟังก์ชันช่วยเหลือสำหรับแปลงค่าเป็นทศนิยมเพื่อการคำนวณ ---
-def to_float(val):
-    try:
-        if isinstance(val, str): val = val.replace(',', '')
-        return float(val) if val is not None else 0.0
-    except:
-        return 0.0
+from database import load_data, save_data, marked_deleted, save_history_doc, delete_rows, compact_tombstones, migrate_history_payloads, load_history_payload, load_history_payloads, generate_doc_no, allocate_doc_no, get_product_index, to_int, CUST_FILE, PROD_FILE, HISTORY_FILE, SOFT_DELETE
+from pdf_generator import create_pdf, convert_pdf_to_image, image_export_info, warm_up, layout_items, make_job, job_totals, render_job, payload_doc_date, render_cache, image_cache, HAS_IMG_LIB
+from batch_render import render_zip, archive_zip
+from blob_cache import session_blobs
+from pdf_archive import archive_pdf, archived_pdf, archived_doc_nos, archive_stats
+from pricing import line_amounts, summarize
+from doc_payload import missing_render_fields, compact_items, items_frame, PAYLOAD_VERSION, EDITOR_MIN_ROWS
 
 # --- ฟังก์ชันจัดการขนาดรูปลายเซ็นโดยไม่ลดพิกเซล (เพิ่มขอบใสแทนเพื่อให้ PDF บีบรูปลงเอง) ---
 def resize_signature(file_obj, extra_top=2.0, extra_width=0.5):
@@ -182,14 +178,14 @@ if "grid_df" not in st.session_state:
     st.session_state.grid_df = pd.DataFrame(
         [{"รหัสสินค้า": "", "รายการ": "", "จำนวน": 0.0, "หน่วย": "", "ราคา": 0.0, "ส่วนลด": 0.0}] * 15
     )
-if "generated_pdf_bytes" not in st.session_state:
-    st.session_state.generated_pdf_bytes = None
+if "blob_handles" not in st.session_state:
+    st.session_state.blob_handles = {}   # ชื่อ -> (key ใน session_blobs, ขนาด bytes)
 if "last_doc_no" not in st.session_state:
     st.session_state.last_doc_no = ""
-if "convert_pdf_bytes" not in st.session_state:
-    st.session_state.convert_pdf_bytes = None
 if "convert_filename" not in st.session_state:
     st.session_state.convert_filename = ""
+if "batch_zip_name" not in st.session_state:
+    st.session_state.batch_zip_name = ""
 
 # ==========================================
 # 2. EMAIL SYSTEM FUNCTION
@@ -218,25 +214,111 @@ def send_email_with_attachment(sender_email, sender_password, receiver_email, su
     except Exception as e:
         return False, f"เกิดข้อผิดพลาด: {str(e)}"
 
+@st.cache_resource
+def warm_up_pdf_engine():
+    # parse ฟอนต์/โลโก้ครั้งเดียวต่อโปรเซส เอกสารใบแรกของทุก session จะได้ไม่ต้องรอ
+    return warm_up()
+
+@st.cache_data(show_spinner=False)
+def estimate_pdf_pages(items_df):
+    # วางผังตารางอย่างเดียว (ไม่สร้าง PDF) เพื่อบอกจำนวนหน้าก่อนกดพิมพ์
+    try:
+        return layout_items(items_df)['pages']
+    except Exception:
+        return None
+
+def set_session_blob(name, data):
+    # ไฟล์ใหญ่ (PDF/zip) ไม่เก็บใน session_state ตรงๆ เก็บแค่ handle ข้อมูลจริงอยู่ใน session_blobs (ล้นแล้วลงดิสก์)
+    if data:
+        st.session_state.blob_handles[name] = (session_blobs.put_blob(data), len(data))
+    else:
+        st.session_state.blob_handles.pop(name, None)
+
+def get_session_blob(name):
+    handle = st.session_state.blob_handles.get(name)
+    if handle is None:
+        return None
+    data = session_blobs.get(handle[0])
+    if data is None:
+        # ถูกลบออกจากดิสก์ไปแล้ว (เกินโควตา) ถือว่าไม่มีไฟล์ ให้สร้างใหม่
+        st.session_state.blob_handles.pop(name, None)
+    return data
+
+def session_blob_bytes():
+    return sum(size for _, size in st.session_state.blob_handles.values())
+
 load_data()
+warm_up_pdf_engine()
 
 # ==========================================
 # 3. USER INTERFACE
 # ==========================================
 
-def display_pdf(pdf_bytes):
-    base64_pdf = base64.b64encode(pdf_bytes).decode('utf-8')
-    pdf_display = f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="100%" height="600" type="application/pdf"></iframe>'
+def image_export_options(key_prefix, export_format):
+    # ความละเอียด + แยกไฟล์ทีละหน้า (TIFF เป็นหลายหน้าในไฟล์เดียวอยู่แล้ว)
+    o1, o2 = st.columns(2)
+    with o1:
+        img_dpi = st.select_slider("ความละเอียด (DPI)", options=[100, 150, 200, 300], value=150, key=f"img_dpi_{key_prefix}")
+    with o2:
+        per_page = st.checkbox("แยกไฟล์ทีละหน้า (zip)", key=f"img_pages_{key_prefix}", disabled=export_format == "TIFF")
+    return img_dpi, ("pages" if per_page and export_format != "TIFF" else "stitched")
+
+def image_download_data(pdf_bytes, export_format, img_dpi, img_layout):
+    # แปลงตอนกดดาวน์โหลดจริงเท่านั้น (download_button เรียก callable ตอนคลิก) ไม่ใช่ทุกครั้งที่หน้า rerun
+    # แปลงซ้ำด้วยค่าเดิมได้ผลจาก image_cache ทันที
+    def build():
+        img_bytes, err = convert_pdf_to_image(pdf_bytes, export_format, dpi=img_dpi, layout=img_layout)
+        if err:
+            raise RuntimeError(f"ไม่สามารถแปลงไฟล์ได้: {err}")
+        return img_bytes
+    return build
+
+def pdf_blob_url(pdf_bytes, key):
+    # ฝาก PDF ไว้กับ media file manager ของ Streamlit ได้ URL /media/<hash>.pdf (ไฟล์เดียวกัน = URL เดิม)
+    # ต้องเรียกทุก rerun ที่ยังแสดงอยู่ ไม่งั้น Streamlit จะลบไฟล์ออกหลังรันจบ
+    try:
+        from streamlit import runtime
+        if not runtime.exists():
+            return None
+        url = runtime.get_instance().media_file_mgr.add(pdf_bytes, "application/pdf", f"pdf_preview.{key}")
+        base_path = st.get_option("server.baseUrlPath").strip("/")
+        return f"/{base_path}{url}" if base_path else url
+    except Exception:
+        return None
+
+def display_pdf(pdf_bytes, key="preview"):
+    # rerun ส่งแค่ URL สั้นๆ iframe เดิมไม่ถูกโหลดใหม่ เบราว์เซอร์ดึงไฟล์ครั้งเดียว
+    # ถ้าใช้ media endpoint ไม่ได้ (เช่นรันนอก streamlit server) กลับไปฝัง base64 แบบเดิม
+    src = pdf_blob_url(pdf_bytes, key)
+    if src is None:
+        src = "data:application/pdf;base64," + base64.b64encode(pdf_bytes).decode('utf-8')
+    pdf_display = f'<iframe src="{src}" width="100%" height="600" type="application/pdf"></iframe>'
     st.markdown(pdf_display, unsafe_allow_html=True)
 
+def show_flash(key):
+    # ข้อความผลการบันทึกที่ตั้งไว้ก่อน st.rerun() (st.success ก่อน rerun จะถูกล้างทิ้งก่อนผู้ใช้เห็น)
+    msg = st.session_state.pop(key, None)
+    if msg:
+        st.success(msg)
+
+def conversion_data(data):
+    # payload เก่าไม่มีหัวกระดาษผู้ขาย: ใช้ค่าผู้ขายในฟอร์มตอนนี้แทน (คืน copy และรายการฟิลด์ที่ขาด)
+    missing = missing_render_fields(data)
+    data = dict(data)
+    for key in ("my_comp", "my_addr", "my_tel", "my_tax"):
+        if key not in data:
+            data[key] = st.session_state.get(f"{key}_in", "")
+    return data, missing
+
 def clear_all_data():
     st.session_state.grid_df = pd.DataFrame([{"รหัสสินค้า": "", "รายการ": "", "จำนวน": 0.0, "หน่วย": "", "ราคา": 0.0, "ส่วนลด": 0.0}] * 15)
     reset_keys = ["c_name_in", "contact_in", "c_addr_in", "c_tel_in", "remark_in", "s1_in", "s2_in", "img2_in"]
     for k in reset_keys:
         if k in st.session_state: st.session_state[k] = ""
     st.session_state["cust_selector_tab1"] = "-- พิมพ์เอง --"
-    st.session_state.generated_pdf_bytes = None
+    set_session_blob("generated_pdf", None)
     st.session_state.doc_no_in = generate_doc_no("QT") 
+    st.session_state.doc_no_auto = st.session_state.doc_no_in
     
     if "editor_main" in st.session_state:
         del st.session_state["editor_main"]
@@ -259,6 +341,44 @@ with st.sidebar:
         email_sender = st.text_input("อีเมลผู้ส่ง (Sender)", placeholder="your@gmail.com")
         email_password = st.text_input("รหัสผ่านแอพ (App Password)", type="password")
     
+    if SOFT_DELETE:
+        with st.expander("🧹 ล้างข้อมูลที่ถูกลบ (Compaction)", expanded=False):
+            st.caption("ลบแถวที่ติ๊ก 'ลบ' ไว้ออกจากฐานข้อมูลจริง")
+            if st.button("ล้างข้อมูลตอนนี้", use_container_width=True):
+                purged = sum(compact_tombstones(t) for t in [CUST_FILE, PROD_FILE, HISTORY_FILE])
+                st.success(f"ล้างข้อมูลแล้ว {purged} แถว")
+
+    with st.expander("🗜️ ย่อขนาดประวัติเอกสาร", expanded=False):
+        st.caption("แปลง data_json ของเอกสารเก่าเป็นรูปแบบใหม่ (เก็บเฉพาะรายการที่มีข้อมูล)")
+        if st.button("แปลงตอนนี้", use_container_width=True):
+            migrated = migrate_history_payloads()
+            st.success(f"แปลงแล้ว {migrated} เอกสาร")
+
+    with st.expander("📄 แคช PDF", expanded=False):
+        cache_stats = render_cache.stats()
+        st.caption(
+            f"Hit rate {cache_stats['hit_rate']:.0%} "
+            f"({cache_stats['hits']} hit / {cache_stats['misses']} miss, จากดิสก์ {cache_stats['disk_hits']})"
+        )
+        st.caption(f"ในหน่วยความจำ {cache_stats['entries']} ไฟล์ {cache_stats['bytes'] / 1024 / 1024:.1f} MB")
+        img_stats = image_cache.stats()
+        st.caption(f"รูปที่แปลงแล้ว: hit rate {img_stats['hit_rate']:.0%}, {img_stats['entries']} ไฟล์ {img_stats['bytes'] / 1024 / 1024:.1f} MB")
+        if st.button("ล้างแคช PDF", use_container_width=True):
+            render_cache.clear()
+            image_cache.clear()
+            st.rerun()
+        arc_stats = archive_stats()
+        if arc_stats:
+            st.caption(
+                f"คลัง PDF: {arc_stats['docs']} เอกสาร "
+                f"{arc_stats['bytes'] / 1024 / 1024:.1f} MB (บีบอัดแล้ว {arc_stats['stored_bytes'] / 1024 / 1024:.1f} MB)"
+            )
+        blob_stats = session_blobs.stats()
+        st.caption(
+            f"ไฟล์ของ session นี้ {session_blob_bytes() / 1024 / 1024:.1f} MB "
+            f"(ทุก session: ในหน่วยความจำ {blob_stats['bytes'] / 1024 / 1024:.1f} MB, บนดิสก์ {blob_stats['disk_bytes'] / 1024 / 1024:.1f} MB)"
+        )
+    
     st.divider()
     st.caption("© 2024 Siwakit Trading System v2.0")
 
@@ -301,7 +421,13 @@ with tab1:
             st.markdown("""<div style="background-color:#eff6ff; padding:15px; border-radius:10px;">""", unsafe_allow_html=True)
             dc1, dc2 = st.columns(2)
             with dc1:
-                st.text_input("เลขที่ใบเสนอราคา", value=generate_doc_no("QT"), key="doc_no_in")
+                # เลขที่แสดงเป็นแค่ตัวอย่าง เลขจริงจะถูกจองตอนกดบันทึก (allocate_doc_no)
+                if "pending_doc_no" in st.session_state:
+                    st.session_state.doc_no_in = st.session_state.pop("pending_doc_no")
+                if "doc_no_in" not in st.session_state:
+                    st.session_state.doc_no_in = generate_doc_no("QT")
+                    st.session_state.doc_no_auto = st.session_state.doc_no_in
+                st.text_input("เลขที่ใบเสนอราคา", key="doc_no_in")
                 st.text_input("ยืนราคา (วัน)", "30", key="valid_days_in")
             with dc2:
                 st.date_input("วันที่เอกสาร", date.today(), key="doc_date_in")
@@ -346,16 +472,17 @@ with tab1:
         )
 
         needs_rerun = False
-        for idx, row in edited_df.iterrows():
-            code_input = str(row['รหัสสินค้า']).strip()
+        # ค้นหาสินค้าจาก hash index (รหัสตัวพิมพ์เล็ก -> ข้อมูลสินค้า) แทนการสแกนทั้งแคตตาล็อกทุกแถว
+        product_index = get_product_index(st.session_state.db_products)
+        for idx, code_val, name_val in zip(edited_df.index, edited_df['รหัสสินค้า'], edited_df['รายการ']):
+            code_input = str(code_val).strip()
             if code_input:
-                matched_rows = st.session_state.db_products[st.session_state.db_products['รหัสสินค้า'].astype(str).str.lower() == code_input.lower()]
+                info = product_index.get(code_input.lower())
                 
-                if not matched_rows.empty:
-                    info = matched_rows.iloc[0]
+                if info is not None:
                     exact_db_code = str(info['รหัสสินค้า'])
                     
-                    if str(row['รหัสสินค้า']) != exact_db_code or str(row['รายการ']) != info['รายการ']:
+                    if str(code_val) != exact_db_code or str(name_val) != info['รายการ']:
                         edited_df.at[idx, 'รหัสสินค้า'] = exact_db_code
                         edited_df.at[idx, 'รายการ'] = info['รายการ']
                         edited_df.at[idx, 'หน่วย'] = info['หน่วย']
@@ -369,14 +496,12 @@ with tab1:
             st.rerun()
 
     calc_df = edited_df.copy()
-    calc_df['q'] = calc_df['จำนวน'].apply(to_float)
-    calc_df['p'] = calc_df['ราคา'].apply(to_float)
-    calc_df['d'] = calc_df['ส่วนลด'].apply(to_float)
-    calc_df['total'] = calc_df.apply(lambda x: round((x['q'] * x['p']) - x['d'], 2), axis=1)
+    price_lines = line_amounts(calc_df)
+    pre_vat = summarize(price_lines, has_vat=False)
     
-    sum_gross = (calc_df['q'] * calc_df['p']).sum()
-    sum_disc = calc_df['d'].sum()
-    sum_sub = calc_df['total'].sum()
+    sum_gross = pre_vat['gross']
+    sum_disc = pre_vat['discount']
+    sum_sub = pre_vat['subtotal']
 
     with st.expander("📊 สรุปยอดและบันทึกเอกสาร", expanded=True):
         f_col1, f_col2 = st.columns([1.8, 1])
@@ -401,12 +526,15 @@ with tab1:
 
         with f_col2:
             has_vat = st.checkbox("คำนวณ VAT 7%", value=True)
-            vat_val = round(sum_sub * 0.07, 2) if has_vat else 0.0
-            grand_total = sum_sub + vat_val
+            totals = summarize(price_lines, has_vat)
+            vat_val = totals['vat']
+            grand_total = totals['grand_total']
             
             baht_text_show = bahttext(grand_total)
             
             vat_style = "" if has_vat else "display: none;"
+            pdf_pages = estimate_pdf_pages(calc_df)
+            pages_style = "" if pdf_pages else "display: none;"
             
             st.markdown(f"""
             <div class="metric-card">
@@ -419,6 +547,7 @@ with tab1:
                         <tr><td style="text-align: left; color:#666;">ส่วนลด:</td><td style="text-align: right; color: #dc2626;">-{sum_disc:,.2f}</td></tr>
                         <tr><td style="text-align: left; font-weight: 600;">ก่อนภาษี:</td><td style="text-align: right; font-weight: 600;">{sum_sub:,.2f}</td></tr>
                         <tr style="{vat_style}"><td style="text-align: left; color:#666;">VAT 7%:</td><td style="text-align: right;">{vat_val:,.2f}</td></tr>
+                        <tr style="{pages_style}"><td style="text-align: left; color:#666;">จำนวนหน้า PDF:</td><td style="text-align: right;">{pdf_pages}</td></tr>
                     </table>
                 </div>
             </div>
@@ -432,30 +561,57 @@ with tab1:
         with b2:
             if st.button("🚀 บันทึกและพิมพ์ PDF", type="primary", use_container_width=True):
                 doc_no = st.session_state.doc_no_in
+                if doc_no == st.session_state.get("doc_no_auto"):
+                    # ⭐ เลขอัตโนมัติ: จองเลขจริงแบบ atomic กันสองคนได้เลขเดียวกัน
+                    try:
+                        doc_no = allocate_doc_no("QT")
+                    except Exception as e:
+                        st.error(f"จองเลขเอกสารไม่ได้: {e}")
+                        st.stop()
+                    st.session_state.doc_no_auto = None
+                    st.session_state.pending_doc_no = doc_no
+                st.session_state.last_doc_no = doc_no
+
+                doc_date_str = datetime.strptime(str(st.session_state.doc_date_in), "%Y-%m-%d").strftime("%d/%m/%Y")
+                try:
+                    vd = int(st.session_state.valid_days_in)
+                    exp_date = (datetime.strptime(str(st.session_state.doc_date_in), "%Y-%m-%d") + timedelta(days=vd)).strftime("%d/%m/%Y")
+                except:
+                    exp_date = doc_date_str
+
+                # เก็บข้อมูลที่ใช้สร้าง PDF ให้ครบ (ดู doc_payload.RENDER_FIELDS) แปลงเป็น IV/RE ทีหลังจะได้หัวกระดาษและ VAT ตรงกัน
                 json_data = {
-                    "grid_df": edited_df.to_dict(),
+                    "v": PAYLOAD_VERSION,
+                    "items": compact_items(edited_df),
                     "doc_date_str": str(st.session_state.doc_date_in),
+                    "exp_date": exp_date,
                     "due_date": st.session_state.due_date_in,
                     "valid_days": st.session_state.valid_days_in,
+                    "my_comp": st.session_state.my_comp_in,
+                    "my_addr": st.session_state.my_addr_in,
+                    "my_tel": st.session_state.my_tel_in,
+                    "my_tax": st.session_state.my_tax_in,
                     "c_name": st.session_state.c_name_in,
                     "contact": st.session_state.contact_in,
                     "c_addr": st.session_state.c_addr_in,
-                    "c_tel": st.session_state.c_tel_in
+                    "c_tel": st.session_state.c_tel_in,
+                    "vat": vat_val,
+                    "remark": st.session_state.remark_in,
+                    "s1": st.session_state.get("s1_in", ""),
+                    "s2": st.session_state.get("s2_in", "")
                 }
                 
-                # ลบของเก่าทิ้งหากมีการดึงมาแก้ไขแล้วเซฟด้วยเลขเดิม (Overwriting History)
-                st.session_state.db_history = st.session_state.db_history[st.session_state.db_history['doc_no'] != doc_no]
-                
-                new_hist = pd.DataFrame([{
+                # บันทึกทับเลขเดิมได้เลยหากดึงมาแก้ไข (upsert ตาม doc_no ใน request เดียว)
+                st.session_state.db_history, saved = save_history_doc({
                     "ลบ": False,
                     "doc_no": doc_no,
-                    "date": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                     "c_name": st.session_state.c_name_in,
                     "total": grand_total,
-                    "data_json": json.dumps(json_data, ensure_ascii=False)
-                }])
-                st.session_state.db_history = pd.concat([st.session_state.db_history, new_hist], ignore_index=True)
-                st.session_state.db_history = save_data(st.session_state.db_history, HISTORY_FILE, "doc_no")
+                    "data_json": json_data
+                }, return_saved=True)
+                if not saved:
+                    # ไม่มีในประวัติ = ไม่ออกเอกสาร (ไม่เก็บเข้าคลัง เลขนี้อาจถูกใช้ใหม่ภายหลัง)
+                    st.stop()
                 
                 if st.session_state.c_name_in and st.session_state.c_name_in not in st.session_state.db_customers['ชื่อบริษัท'].values:
                     new_cust = pd.DataFrame([{
@@ -469,13 +625,6 @@ with tab1:
                     st.session_state.db_customers = pd.concat([st.session_state.db_customers, new_cust], ignore_index=True)
                     st.session_state.db_customers = save_data(st.session_state.db_customers, CUST_FILE, "รหัส")
                 
-                doc_date_str = datetime.strptime(str(st.session_state.doc_date_in), "%Y-%m-%d").strftime("%d/%m/%Y")
-                try:
-                    vd = int(st.session_state.valid_days_in)
-                    exp_date = (datetime.strptime(str(st.session_state.doc_date_in), "%Y-%m-%d") + timedelta(days=vd)).strftime("%d/%m/%Y")
-                except:
-                    exp_date = doc_date_str
-                
                 pdf_data = {
                     "my_comp": st.session_state.my_comp_in, "my_addr": st.session_state.my_addr_in,
                     "my_tel": st.session_state.my_tel_in, "my_tax": st.session_state.my_tax_in,
@@ -502,51 +651,53 @@ with tab1:
                 }
                 
                 pdf_bytes = create_pdf(
-                    pdf_data, calc_df,
-                    {"gross": sum_gross, "discount": sum_disc, "subtotal": sum_sub, "vat": vat_val, "grand_total": grand_total},
+                    pdf_data, calc_df, totals,
                     sigs, st.session_state.remark_in, has_vat, doc_title="ใบเสนอราคา (QUOTATION)"
                 )
                 
-                st.session_state.generated_pdf_bytes = pdf_bytes
+                archive_pdf(doc_no, pdf_bytes)
+                set_session_blob("generated_pdf", pdf_bytes)
                 if lottie_success:
                     st_lottie(lottie_success, height=150, key="success_anim")
                 st.success(f"บันทึกเอกสาร {doc_no} เรียบร้อย!")
                 
-    if st.session_state.generated_pdf_bytes:
+    generated_pdf = get_session_blob("generated_pdf")
+    if generated_pdf:
         st.markdown("##### 📄 ตัวอย่างเอกสาร (Preview)")
-        display_pdf(st.session_state.generated_pdf_bytes)
+        display_pdf(generated_pdf)
         
         st.markdown("##### 📥 ดาวน์โหลดเอกสาร")
-        export_format = st.radio("เลือกนามสกุลไฟล์ที่ต้องการดาวน์โหลด:", ["PDF", "JPG", "PNG"], horizontal=True, key="export_format_tab1")
+        export_format = st.radio("เลือกนามสกุลไฟล์ที่ต้องการดาวน์โหลด:", ["PDF", "JPG", "PNG", "TIFF"], horizontal=True, key="export_format_tab1")
         
         if export_format == "PDF":
             st.download_button(
                 label="📄 ดาวน์โหลด PDF",
-                data=st.session_state.generated_pdf_bytes,
-                file_name=f"Quotation_{st.session_state.doc_no_in}.pdf",
+                data=generated_pdf,
+                file_name=f"Quotation_{st.session_state.last_doc_no}.pdf",
                 mime="application/pdf",
                 type="secondary"
             )
         else:
-            img_bytes, err = convert_pdf_to_image(st.session_state.generated_pdf_bytes, export_format)
-            if img_bytes:
+            img_dpi, img_layout = image_export_options("tab1", export_format)
+            img_ext, img_mime = image_export_info(export_format, img_layout)
+            if HAS_IMG_LIB:
                 st.download_button(
                     label=f"🖼️ ดาวน์โหลด {export_format}",
-                    data=img_bytes,
-                    file_name=f"Quotation_{st.session_state.doc_no_in}.{export_format.lower()}",
-                    mime=f"image/{export_format.lower()}",
+                    data=image_download_data(generated_pdf, export_format, img_dpi, img_layout),
+                    file_name=f"Quotation_{st.session_state.last_doc_no}.{img_ext}",
+                    mime=img_mime,
                     type="secondary"
                 )
             else:
-                st.error(f"ไม่สามารถแปลงไฟล์ได้: {err}")
+                st.error("ไม่สามารถแปลงไฟล์ได้: กรุณาติดตั้งไลบรารีเพิ่มเติม: pip install PyMuPDF Pillow")
 
         with st.expander("📧 ส่งอีเมลหาลูกค้าทันที"):
             em_receiver = st.text_input("อีเมลลูกค้า", placeholder="client@example.com")
-            em_subject = st.text_input("หัวข้อ", value=f"ใบเสนอราคา {st.session_state.doc_no_in}")
+            em_subject = st.text_input("หัวข้อ", value=f"ใบเสนอราคา {st.session_state.last_doc_no}")
             em_body = st.text_area("ข้อความ", value="เรียน ลูกค้า,\n\nแนบมาพร้อมกับใบเสนอราคา\n\nขอบคุณครับ")
             if st.button("ส่งอีเมล"):
                 if email_sender and email_password and em_receiver:
-                    success, msg = send_email_with_attachment(email_sender, email_password, em_receiver, em_subject, em_body, st.session_state.generated_pdf_bytes, f"QT_{st.session_state.doc_no_in}.pdf")
+                    success, msg = send_email_with_attachment(email_sender, email_password, em_receiver, em_subject, em_body, generated_pdf, f"QT_{st.session_state.last_doc_no}.pdf")
                     if success:
                         st.success(msg)
                     else:
@@ -559,6 +710,7 @@ with tab1:
 # ------------------------------------------------------------------
 with tab2:
     st.header("👥 ฐานข้อมูลลูกค้า")
+    show_flash("flash_cust")
     st.info("💡 วิธีใช้: กรอกข้อมูลในบรรทัดใหม่ได้เลย ข้อมูลจะบันทึกเมื่อกดปุ่ม 'บันทึก' หากต้องการลบ ให้ติ๊กช่อง 'ลบ' แล้วกดบันทึก")
     
     cust_df = st.session_state.db_customers.copy()
@@ -584,11 +736,15 @@ with tab2:
     )
 
     if st.button("💾 บันทึกข้อมูลลูกค้า", type="primary"):
-        to_save = edited_cust[edited_cust['ลบ'] == False].copy()
-        # ✅ FIX: นำค่าจากตารางที่ผู้ใช้แก้ (to_save) ไปเขียนทับ session_state ก่อนเซฟ
-        st.session_state.db_customers = to_save 
-        save_data(st.session_state.db_customers, CUST_FILE, key_col="ชื่อบริษัท")
-        st.success("บันทึกเรียบร้อย!")
+        # ✅ ลบแถวที่ติ๊ก "ลบ" ที่ฐานข้อมูลจริง แล้วค่อยบันทึกแถวที่เหลือ
+        # แถวที่ลบออกจากตาราง (ไม่ได้ติ๊ก) save_data ลบให้ด้วย delete_missing
+        del_mask = marked_deleted(edited_cust)
+        del_ids = edited_cust.loc[del_mask, 'id'].tolist() if 'id' in edited_cust.columns else []
+        delete_rows(CUST_FILE, del_ids)
+        to_save = edited_cust[~del_mask].copy()
+        # ✅ FIX: ใช้ผลลัพธ์จาก save_data (มี id ของแถวใหม่แล้ว) เขียนทับ session_state
+        st.session_state.db_customers, save_stats = save_data(to_save, CUST_FILE, key_col="ชื่อบริษัท", return_stats=True, delete_missing=True)
+        st.session_state.flash_cust = f"บันทึกเรียบร้อย! (บันทึก {save_stats['written']} แถว, ลบ {len(del_ids)} แถว)"
         st.rerun()
 
 # ------------------------------------------------------------------
@@ -596,6 +752,7 @@ with tab2:
 # ------------------------------------------------------------------
 with tab3:
     st.header("📦 ฐานข้อมูลสินค้า")
+    show_flash("flash_prod")
     prod_df = st.session_state.db_products.copy()
     
     cols_p = list(prod_df.columns)
@@ -619,11 +776,13 @@ with tab3:
     )
 
     if st.button("💾 บันทึกข้อมูลสินค้า", type="primary"):
-        to_save_p = edited_prod[edited_prod['ลบ'] == False].copy()
-        # ✅ FIX: นำค่าจากตารางไปเขียนทับ session_state 
-        st.session_state.db_products = to_save_p
-        save_data(st.session_state.db_products, PROD_FILE, key_col="รหัสสินค้า")
-        st.success("บันทึกเรียบร้อย!")
+        del_mask_p = marked_deleted(edited_prod)
+        del_ids_p = edited_prod.loc[del_mask_p, 'id'].tolist() if 'id' in edited_prod.columns else []
+        delete_rows(PROD_FILE, del_ids_p)
+        to_save_p = edited_prod[~del_mask_p].copy()
+        # ✅ FIX: ใช้ผลลัพธ์จาก save_data เขียนทับ session_state 
+        st.session_state.db_products, save_stats = save_data(to_save_p, PROD_FILE, key_col="รหัสสินค้า", return_stats=True, delete_missing=True)
+        st.session_state.flash_prod = f"บันทึกเรียบร้อย! (บันทึก {save_stats['written']} แถว, ลบ {len(del_ids_p)} แถว)"
         st.rerun()
 
 # ------------------------------------------------------------------
@@ -636,6 +795,7 @@ with tab4:
         with col_hist1:
             st.markdown("""<div class="custom-card">""", unsafe_allow_html=True)
             st.subheader("🗂️ ประวัติเอกสารทั้งหมด")
+            show_flash("flash_hist")
             hist_df_display = st.session_state.db_history.copy()
             if 'data_json' in hist_df_display.columns:
                 hist_df_display = hist_df_display.drop(columns=['data_json'])
@@ -652,12 +812,10 @@ with tab4:
             )
 
             if st.button("🗑️ บันทึกการลบเอกสาร", type="primary", use_container_width=True):
-                st.session_state.db_history['ลบ'] = edited_hist['ลบ'].values
-                to_save_h = st.session_state.db_history[st.session_state.db_history['ลบ'] == False].copy()
-                # ✅ FIX: นำค่าไปเขียนทับ session_state เพื่อให้ลบจริงและไม่เด้งกลับมา
-                st.session_state.db_history = to_save_h
-                save_data(st.session_state.db_history, HISTORY_FILE, key_col="doc_no")
-                st.success("ลบเอกสารที่เลือกเรียบร้อย!")
+                # ✅ FIX: ลบตาม id ที่ฐานข้อมูลจริง เพื่อไม่ให้เอกสารเด้งกลับมาตอนโหลดใหม่
+                del_ids_h = st.session_state.db_history.loc[marked_deleted(edited_hist).values, 'id'].tolist()
+                st.session_state.db_history = delete_rows(HISTORY_FILE, del_ids_h)
+                st.session_state.flash_hist = "ลบเอกสารที่เลือกเรียบร้อย!"
                 st.rerun()
             st.markdown("</div>", unsafe_allow_html=True)
 
@@ -678,12 +836,13 @@ with tab4:
                 
                 if selected_qt:
                     row_data = st.session_state.db_history[st.session_state.db_history['doc_no'] == selected_qt].iloc[0]
-                    json_raw = row_data['data_json']
                     try:
-                        data = json.loads(json_raw)
+                        data, missing_fields = conversion_data(load_history_payload(row_data))
                         st.divider()
                         st.markdown(f"**ลูกค้า:** {data.get('c_name', '-')}")
                         st.markdown(f"**ยอดรวม:** {row_data['total']:,.0f} บาท")
+                        if missing_fields:
+                            st.warning("เอกสารเก่า ไม่ได้เก็บหัวกระดาษผู้ขาย/VAT ไว้: ใช้ข้อมูลผู้ขายในฟอร์มปัจจุบัน และดู VAT จากยอดรวมที่บันทึกไว้")
                         
                         c_btn1, c_btn2 = st.columns(2)
                         action_type = None
@@ -695,66 +854,169 @@ with tab4:
                                 action_type = "RE"
                                 
                         if action_type:
-                            new_doc_no = generate_doc_no(action_type)
-                            items_df = pd.DataFrame.from_dict(data['grid_df'])
-                            
-                            items_df['q'] = items_df['จำนวน'].apply(to_float)
-                            items_df['p'] = items_df['ราคา'].apply(to_float)
-                            items_df['d'] = items_df['ส่วนลด'].apply(to_float)
-                            items_df['total'] = items_df.apply(lambda x: round((x['q'] * x['p']) - x['d'], 2), axis=1)
+                            new_doc_no = allocate_doc_no(action_type)
+                            job = make_job(data, new_doc_no, convert_date.strftime("%d/%m/%Y"), action_type, recorded_total=row_data['total'])
+                            new_totals = job_totals(job)
+                            grand_total = new_totals['grand_total']
+                            doc_title_new = job['doc_title']
                             
-                            sum_gross = (items_df['q'] * items_df['p']).sum()
-                            sum_disc = items_df['d'].sum()
-                            sum_sub = items_df['total'].sum()
-                            
-                            has_vat = "vat" in data and data["vat"] > 0
-                            vat_val = round(sum_sub * 0.07, 2) if has_vat else 0.0
-                            grand_total = sum_sub + vat_val
-                            
-                            doc_title_new = "ใบแจ้งหนี้ (INVOICE)" if action_type == "IV" else "ใบเสร็จรับเงิน (RECEIPT)"
-                            doc_date_str_new = convert_date.strftime("%d/%m/%Y")
-                            
-                            pdf_data = {
-                                "my_comp": data.get("my_comp", ""), "my_addr": data.get("my_addr", ""),
-                                "my_tel": data.get("my_tel", ""), "my_tax": data.get("my_tax", ""),
-                                "doc_no": new_doc_no, "doc_date": doc_date_str_new, "exp_date": data.get("exp_date", ""),
-                                "valid_days": data.get("valid_days", ""), "due_date": data.get("due_date", ""),
-                                "c_name": data.get("c_name", ""), "contact": data.get("contact", ""),
-                                "c_addr": data.get("c_addr", ""), "c_tel": data.get("c_tel", "")
-                            }
-                            
-                            sigs = {"s1": "", "s2": "", "s3": "", "img1": None, "img2": None, "img3": None}
-                            remark = "" 
-                            
-                            converted_pdf = create_pdf(
-                                pdf_data, items_df,
-                                {"gross": sum_gross, "discount": sum_disc, "subtotal": sum_sub, "vat": vat_val, "grand_total": grand_total},
-                                sigs, remark, has_vat, doc_title=doc_title_new
-                            )
-                            
-                            st.session_state.convert_pdf_bytes = converted_pdf
-                            st.session_state.convert_filename = new_doc_no
+                            converted_pdf = render_job(job)
                             
                             json_data_new = data.copy()
                             json_data_new['doc_date_str'] = str(convert_date)
+                            json_data_new['vat'] = new_totals['vat']
                             
-                            new_hist = pd.DataFrame([{
+                            st.session_state.db_history, saved = save_history_doc({
                                 "ลบ": False,
                                 "doc_no": new_doc_no,
-                                "date": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                                 "c_name": data.get("c_name", ""),
                                 "total": grand_total,
-                                "data_json": json.dumps(json_data_new, ensure_ascii=False)
-                            }])
-                            st.session_state.db_history = pd.concat([st.session_state.db_history, new_hist], ignore_index=True)
-                            st.session_state.db_history = save_data(st.session_state.db_history, HISTORY_FILE, "doc_no")
+                                "data_json": json_data_new
+                            }, return_saved=True)
                             
-                            st.success(f"สร้าง {doc_title_new} เลขที่ {new_doc_no} สำเร็จ! (บันทึกลงประวัติแล้ว)")
+                            # เก็บเข้าคลังเฉพาะเอกสารที่บันทึกลงประวัติแล้ว
+                            if saved:
+                                archive_pdf(new_doc_no, converted_pdf)
+                                set_session_blob("convert_pdf", converted_pdf)
+                                st.session_state.convert_filename = new_doc_no
+                                st.success(f"สร้าง {doc_title_new} เลขที่ {new_doc_no} สำเร็จ! (บันทึกลงประวัติแล้ว)")
 
                     except Exception as e:
                         st.error(f"Error parsing data: {e}")
             st.markdown("</div>", unsafe_allow_html=True)
 
+            # --- REPRINT SECTION ---
+            st.markdown("""<div class="custom-card">""", unsafe_allow_html=True)
+            st.subheader("🖨️ พิมพ์ซ้ำ (Reprint)")
+            st.write("ดาวน์โหลดไฟล์ PDF ที่ออกไปแล้วจากคลัง (ไฟล์เดียวกับที่ส่งลูกค้า ไม่ต้องสร้างใหม่)")
+
+            reprint_docs = st.session_state.db_history['doc_no'].astype(str).tolist()
+            reprint_doc = st.selectbox("เลือกเอกสาร", reprint_docs, key="reprint_doc")
+            if reprint_doc:
+                if reprint_doc in archived_doc_nos([reprint_doc]):
+                    st.download_button(
+                        label=f"ดาวน์โหลด {reprint_doc}.pdf",
+                        data=lambda: archived_pdf(reprint_doc),
+                        file_name=f"{reprint_doc}.pdf",
+                        mime="application/pdf",
+                        use_container_width=True
+                    )
+                else:
+                    # เอกสารที่ออกก่อนมีคลัง: สร้างใหม่จาก data_json ได้ แต่เป็นแค่ฉบับจำลอง (ไม่มีรูปลายเซ็น ข้อมูลเก่าอาจไม่ครบ)
+                    # จึงไม่เก็บเข้าคลัง (คลังมีเฉพาะไฟล์ที่ออกจริง) เก็บไว้ใน session และติดป้าย/ชื่อไฟล์ให้ชัด
+                    st.caption("ยังไม่มีไฟล์ในคลัง (เอกสารเก่า)")
+                    if st.button("สร้างฉบับจำลองจากข้อมูลที่บันทึกไว้", use_container_width=True, key="reprint_render"):
+                        row_data = st.session_state.db_history[st.session_state.db_history['doc_no'].astype(str) == reprint_doc].iloc[0]
+                        try:
+                            data, _ = conversion_data(load_history_payload(row_data))
+                            job = make_job(data, reprint_doc, payload_doc_date(data), reprint_doc[:2], recorded_total=row_data['total'])
+                            set_session_blob("reconstructed_pdf", render_job(job))
+                            st.session_state.reconstructed_doc = reprint_doc
+                        except Exception as e:
+                            st.error(f"Error parsing data: {e}")
+                    reconstructed_pdf = get_session_blob("reconstructed_pdf") if st.session_state.get("reconstructed_doc") == reprint_doc else None
+                    if reconstructed_pdf:
+                        st.warning("ฉบับจำลอง สร้างใหม่จากข้อมูลที่บันทึกไว้ ไม่ใช่สำเนาตัวจริงที่ส่งลูกค้า")
+                        st.download_button(
+                            label=f"ดาวน์โหลดฉบับจำลอง {reprint_doc}",
+                            data=reconstructed_pdf,
+                            file_name=f"{reprint_doc}_reconstructed.pdf",
+                            mime="application/pdf",
+                            use_container_width=True
+                        )
+            st.markdown("</div>", unsafe_allow_html=True)
+
+            # --- BATCH SECTION ---
+            st.markdown("""<div class="custom-card">""", unsafe_allow_html=True)
+            st.subheader("📦 ทำเอกสารหลายใบ (Batch)")
+            st.write("เลือกใบเสนอราคาหลายใบ เพื่อพิมพ์ซ้ำหรือแปลงเป็น IV/RE ทีเดียว ได้ไฟล์ zip")
+
+            if qt_list:
+                batch_docs = st.multiselect("เลือกใบเสนอราคา", qt_list, key="batch_docs")
+                batch_labels = {"QT": "พิมพ์ซ้ำจากคลัง (QT)", "IV": "ใบแจ้งหนี้ (IV)", "RE": "ใบเสร็จ (RE)"}
+                batch_type = st.radio("ทำเป็น", list(batch_labels), format_func=batch_labels.get, horizontal=True, key="batch_type")
+                batch_date = st.date_input("วันที่เอกสารใหม่ (IV/RE)", date.today(), key="batch_date")
+
+                if st.button("📦 สร้างไฟล์ zip", use_container_width=True, disabled=not batch_docs):
+                    hist = st.session_state.db_history
+                    jobs = []
+                    skipped = []
+                    with st.spinner(f"กำลังสร้าง PDF {len(batch_docs)} ใบ..."):
+                        if batch_type == "QT":
+                            # พิมพ์ซ้ำ = ไฟล์ที่ออกไปแล้วจากคลังเท่านั้น ไม่สร้างใหม่จากข้อมูล (ไม่มีรูปลายเซ็น/ข้อมูลเก่าไม่ครบ)
+                            archived = archived_doc_nos(batch_docs)
+                            skipped = [f"{qt}: ไม่มีไฟล์ในคลัง (พิมพ์ซ้ำได้เฉพาะเอกสารที่ออกหลังมีคลัง PDF)" for qt in batch_docs if qt not in archived]
+                            batch_zip, batch_errors = archive_zip([qt for qt in batch_docs if qt in archived])
+                        else:
+                            # ดึง data_json ของทุกใบที่เลือกใน request เดียว
+                            batch_rows = hist[hist['doc_no'].isin(batch_docs)].drop_duplicates('doc_no')
+                            batch_totals = dict(zip(batch_rows['doc_no'], batch_rows['total']))
+                            try:
+                                batch_payloads = dict(zip(batch_rows['doc_no'], load_history_payloads(batch_rows)))
+                            except Exception:
+                                # มีบางใบโหลดไม่ได้ (data_json ว่าง/เสีย) ไล่โหลดทีละใบเพื่อรู้ว่าใบไหน
+                                batch_payloads = {}
+                                for _, row in batch_rows.iterrows():
+                                    try:
+                                        batch_payloads[row['doc_no']] = load_history_payload(row)
+                                    except Exception as e:
+                                        skipped.append(f"{row['doc_no']}: {e}")
+                            # ตรวจให้ครบทุกใบก่อนออกเลขเอกสาร/บันทึกประวัติ ใบที่เสียข้ามไปแล้วทำใบที่เหลือต่อ
+                            batch_data = {}
+                            for qt in batch_docs:
+                                if qt not in batch_totals:
+                                    skipped.append(f"{qt}: ไม่พบในประวัติ")
+                                elif qt in batch_payloads:
+                                    try:
+                                        batch_data[qt], _ = conversion_data(batch_payloads[qt])
+                                    except Exception as e:
+                                        skipped.append(f"{qt}: {e}")
+                            for qt in batch_docs:
+                                if qt not in batch_data:
+                                    continue
+                                data = batch_data[qt]
+                                try:
+                                    new_doc_no = allocate_doc_no(batch_type)
+                                except Exception as e:
+                                    skipped.append(f"{qt}: จองเลขเอกสารไม่ได้: {e}")
+                                    continue
+                                job = make_job(data, new_doc_no, batch_date.strftime("%d/%m/%Y"), batch_type, recorded_total=batch_totals[qt])
+                                new_totals = job_totals(job)
+                                json_data_new = data.copy()
+                                json_data_new['doc_date_str'] = str(batch_date)
+                                json_data_new['vat'] = new_totals['vat']
+                                st.session_state.db_history, saved = save_history_doc({
+                                    "ลบ": False,
+                                    "doc_no": new_doc_no,
+                                    "c_name": data.get("c_name", ""),
+                                    "total": new_totals['grand_total'],
+                                    "data_json": json_data_new
+                                }, return_saved=True)
+                                # render_zip เก็บเข้าคลัง: ส่งไปเฉพาะใบที่บันทึกลงประวัติแล้ว
+                                if saved:
+                                    jobs.append(job)
+                                else:
+                                    skipped.append(f"{qt}: บันทึก {new_doc_no} ลงประวัติไม่สำเร็จ")
+                            batch_zip, batch_errors = render_zip(jobs)
+                        batch_count = len(batch_docs) - len(skipped)
+                        batch_errors = skipped + batch_errors
+                        set_session_blob("batch_zip", batch_zip)
+                        st.session_state.batch_zip_name = f"{batch_type}_{batch_date.strftime('%Y%m%d')}_{batch_count}.zip"
+                    for err in batch_errors:
+                        st.error(err)
+                    st.success(f"สร้างเอกสาร {len(batch_docs) - len(batch_errors)} ใบเรียบร้อย!")
+
+                batch_zip = get_session_blob("batch_zip")
+                if batch_zip:
+                    st.download_button(
+                        label="🗜️ ดาวน์โหลด zip",
+                        data=batch_zip,
+                        file_name=st.session_state.batch_zip_name,
+                        mime="application/zip",
+                        use_container_width=True
+                    )
+            st.markdown("</div>", unsafe_allow_html=True)
+
             # --- NEW EDIT SECTION ---
             st.markdown("""<div class="custom-card">""", unsafe_allow_html=True)
             st.subheader("✏️ ดึงข้อมูลไปแก้ไข (Load to Edit)")
@@ -763,9 +1025,8 @@ with tab4:
             # --- ฟังก์ชัน Callback สำหรับดึงข้อมูล ---
             def load_doc_to_edit(selected_doc):
                 row_data = st.session_state.db_history[st.session_state.db_history['doc_no'] == selected_doc].iloc[0]
-                json_raw = row_data['data_json']
                 try:
-                    data = json.loads(json_raw)
+                    data = load_history_payload(row_data)
                     st.session_state.doc_no_in = selected_doc
                     if 'my_comp' in data: st.session_state.my_comp_in = data['my_comp']
                     if 'my_addr' in data: st.session_state.my_addr_in = data['my_addr']
@@ -775,9 +1036,12 @@ with tab4:
                     if 'contact' in data: st.session_state.contact_in = data['contact']
                     if 'c_addr' in data: st.session_state.c_addr_in = data['c_addr']
                     if 'c_tel' in data: st.session_state.c_tel_in = data['c_tel']
+                    if 'remark' in data: st.session_state.remark_in = data['remark']
+                    if 's1' in data: st.session_state.s1_in = data['s1']
+                    if 's2' in data: st.session_state.s2_in = data['s2']
                     
-                    if 'grid_df' in data:
-                        st.session_state.grid_df = pd.DataFrame.from_dict(data['grid_df'])
+                    if 'items' in data:
+                        st.session_state.grid_df = items_frame(data['items'], min_rows=EDITOR_MIN_ROWS)
                         if "editor_main" in st.session_state:
                             del st.session_state["editor_main"]
                 except Exception as e:
@@ -794,35 +1058,37 @@ with tab4:
                     st.success(f"โหลดข้อมูล {selected_edit} ไปยังหน้าสร้างใบเสนอราคาแล้ว! กดแท็บ 📝 เพื่อแก้ไขและเซฟทับได้เลย")
             st.markdown("</div>", unsafe_allow_html=True)
 
-            if st.session_state.get('convert_pdf_bytes'):
+            convert_pdf = get_session_blob("convert_pdf")
+            if convert_pdf:
                 st.markdown("""<div class="custom-card">""", unsafe_allow_html=True)
                 st.markdown(f"##### 📥 ดาวน์โหลดเอกสารที่แปลง ({st.session_state.get('convert_filename')})")
-                export_format_t4 = st.radio("เลือกนามสกุลไฟล์:", ["PDF", "JPG", "PNG"], horizontal=True, key="export_format_tab4")
+                export_format_t4 = st.radio("เลือกนามสกุลไฟล์:", ["PDF", "JPG", "PNG", "TIFF"], horizontal=True, key="export_format_tab4")
                 
                 doc_base_name = st.session_state.get('convert_filename', 'document.pdf').replace('.pdf', '')
                 
                 if export_format_t4 == "PDF":
                     st.download_button(
                         label=f"ดาวน์โหลด {doc_base_name}.pdf",
-                        data=st.session_state.convert_pdf_bytes,
+                        data=convert_pdf,
                         file_name=f"{doc_base_name}.pdf",
                         mime="application/pdf",
                         type="primary",
                         use_container_width=True
                     )
                 else:
-                    img_bytes, err = convert_pdf_to_image(st.session_state.convert_pdf_bytes, export_format_t4)
-                    if img_bytes:
+                    img_dpi, img_layout = image_export_options("tab4", export_format_t4)
+                    img_ext, img_mime = image_export_info(export_format_t4, img_layout)
+                    if HAS_IMG_LIB:
                         st.download_button(
-                            label=f"ดาวน์โหลด {doc_base_name}.{export_format_t4.lower()}",
-                            data=img_bytes,
-                            file_name=f"{doc_base_name}.{export_format_t4.lower()}",
-                            mime=f"image/{export_format_t4.lower()}",
+                            label=f"ดาวน์โหลด {doc_base_name}.{img_ext}",
+                            data=image_download_data(convert_pdf, export_format_t4, img_dpi, img_layout),
+                            file_name=f"{doc_base_name}.{img_ext}",
+                            mime=img_mime,
                             type="primary",
                             use_container_width=True
                         )
                     else:
-                        st.error(f"ไม่สามารถแปลงไฟล์ได้: {err}")
+                        st.error("ไม่สามารถแปลงไฟล์ได้: กรุณาติดตั้งไลบรารีเพิ่มเติม: pip install PyMuPDF Pillow")
             
                 st.markdown("</div>", unsafe_allow_html=True)
             
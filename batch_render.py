@@ -0,0 +1,74 @@
+import io
+import zipfile
+from concurrent.futures.process import BrokenProcessPool
+
+from pdf_generator import render_job, get_worker_pool, reset_worker_pool, POOL_WORKERS, DETERMINISTIC, DETERMINISTIC_CREATION_DATE
+from pdf_archive import archive_pdf, archived_pdf
+
+# ==========================================
+# สร้าง PDF หลายใบพร้อมกัน (process pool) แล้วรวมเป็น zip ไฟล์เดียว
+# ==========================================
+# ใช้ process pool กลางตัวเดียวกับการแปลงหน้าเป็นรูป (pdf_generator.get_worker_pool)
+
+def _render_named(job):
+    # ใบที่พังไม่ทำให้ทั้งชุดล้ม คืน error กลับไปแทน
+    # ไม่ใช้แคช PDF: แคชใน worker ไม่มีใครได้ใช้ซ้ำ (ใบที่ออกแล้วอ่านจากคลัง) มีแต่กินหน่วยความจำของ worker ทุกตัว
+    try:
+        return job["filename"], render_job(job, use_cache=False), None
+    except Exception as e:
+        return job["filename"], None, str(e)
+
+def _render_all(jobs):
+    results = None
+    if len(jobs) > 1 and POOL_WORKERS > 1:
+        chunksize = max(1, len(jobs) // (POOL_WORKERS * 4))
+        try:
+            results = list(get_worker_pool().map(_render_named, jobs, chunksize=chunksize))
+        except BrokenProcessPool:
+            reset_worker_pool()
+    if results is None:
+        results = [_render_named(job) for job in jobs]
+    return results
+
+def render_zip(jobs, use_archive=True):
+    # คืนค่า (zip bytes, รายการ error) เรียงไฟล์ตามลำดับ jobs
+    # ใบที่มีในคลัง PDF แล้วใช้ไฟล์เดิม (สำเนาตัวจริง) ใบที่สร้างใหม่เก็บเข้าคลัง
+    stored = {}
+    if use_archive:
+        for job in jobs:
+            pdf_bytes = archived_pdf(job["pdf_data"]["doc_no"])
+            if pdf_bytes is not None:
+                stored[job["filename"]] = pdf_bytes
+    rendered = iter(_render_all([job for job in jobs if job["filename"] not in stored]))
+    results = []
+    for job in jobs:
+        if job["filename"] in stored:
+            results.append((job["filename"], stored[job["filename"]], None))
+            continue
+        result = next(rendered)
+        if use_archive and result[1] is not None:
+            archive_pdf(job["pdf_data"]["doc_no"], result[1])
+        results.append(result)
+    return _write_zip(results)
+
+def archive_zip(doc_nos):
+    # zip ของไฟล์ที่ออกไปแล้วจากคลัง PDF (พิมพ์ซ้ำ) ไม่สร้างใหม่สักใบ
+    results = []
+    for doc_no in doc_nos:
+        pdf_bytes = archived_pdf(doc_no)
+        results.append((f"{doc_no}.pdf", pdf_bytes, None if pdf_bytes is not None else "ไม่มีไฟล์ในคลัง"))
+    return _write_zip(results)
+
+def _write_zip(results):
+    buf = io.BytesIO()
+    errors = []
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+        for filename, pdf_bytes, err in results:
+            if err:
+                errors.append(f"{filename}: {err}")
+            elif DETERMINISTIC:
+                # เวลาในไฟล์ zip คงที่ด้วย zip จะได้เหมือนกันทุก byte เหมือน PDF ข้างใน
+                zf.writestr(zipfile.ZipInfo(filename, DETERMINISTIC_CREATION_DATE.timetuple()[:6]), pdf_bytes)
+            else:
+                zf.writestr(filename, pdf_bytes)
+    return buf.getvalue(), errors
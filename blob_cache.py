@@ -0,0 +1,144 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+# ==========================================
+# แคชข้อมูล binary (PDF, รูป, zip) แบบ 2 ชั้น: หน่วยความจำ (LRU) + ดิสก์ (จำกัดขนาด)
+# ==========================================
+SESSION_BLOB_MB = int(os.environ.get("SESSION_BLOB_MB", 64))
+SESSION_BLOB_DIR = os.environ.get("SESSION_BLOB_DIR") or os.path.join(tempfile.gettempdir(), "siwakit_blobs")
+SESSION_BLOB_DISK_MB = int(os.environ.get("SESSION_BLOB_DISK_MB", 1024))
+
+class BlobCache:
+    # LRU ตามขนาด bytes ในหน่วยความจำ ตัวที่ถูกไล่ออกจะ spill ลงดิสก์ (ถ้าตั้ง disk_dir) แล้วดึงกลับมาได้
+    # ดิสก์ก็จำกัดขนาด (disk_max_bytes) ลบไฟล์ที่ไม่ได้ใช้นานที่สุดก่อน
+    def __init__(self, max_bytes, disk_dir="", disk_max_bytes=0, suffix=".bin"):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.suffix = suffix
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+        data = self._read_disk(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            evicted = self._put_locked(key, data)
+        self._spill(evicted)
+        return data
+
+    def put_blob(self, data):
+        # เก็บแบบ content-addressed: key = hash ของข้อมูล ข้อมูลเดียวกันเก็บครั้งเดียว
+        key = hashlib.blake2b(data, digest_size=20).hexdigest()
+        self.put(key, data)
+        return key
+
+    def put(self, key, data):
+        with self._lock:
+            evicted = self._put_locked(key, data)
+        self._spill(evicted)
+
+    def _put_locked(self, key, data):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        if len(data) > self.max_bytes:
+            return [(key, data)]
+        self._entries[key] = data
+        self._bytes += len(data)
+        evicted = []
+        while self._bytes > self.max_bytes:
+            old_key, old_data = self._entries.popitem(last=False)
+            self._bytes -= len(old_data)
+            evicted.append((old_key, old_data))
+        return evicted
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}{self.suffix}")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self._disk_path(key))
+            return data
+        except OSError:
+            return None
+
+    def _spill(self, evicted):
+        if not evicted or not self.disk_dir:
+            return
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            for key, data in evicted:
+                path = self._disk_path(key)
+                if os.path.exists(path):
+                    continue
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            self._prune_disk()
+        except OSError:
+            pass
+
+    def _prune_disk(self):
+        # ลบไฟล์ที่ใช้ล่าสุดนานที่สุดออกจนขนาดรวมไม่เกิน disk_max_bytes
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(self.suffix):
+                info = os.stat(os.path.join(self.disk_dir, name))
+                files.append((info.st_mtime, info.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+                total -= size
+            except OSError:
+                pass
+        self._disk_bytes = total
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+# ไฟล์ของแต่ละ session (PDF ที่สร้าง, PDF ที่แปลง, zip) ใน session_state เก็บแค่ handle (key)
+# ข้อมูลจริงอยู่ที่นี่ที่เดียว เกินโควตาหน่วยความจำแล้วย้ายลงดิสก์ ไม่โตตามจำนวนแท็บที่เปิด
+session_blobs = BlobCache(SESSION_BLOB_MB * 1024 * 1024, SESSION_BLOB_DIR, SESSION_BLOB_DISK_MB * 1024 * 1024)
@@ -4,6 +4,13 @@ import streamlit as st
 from datetime import datetime, timezone, timedelta
 from supabase import create_client, Client
 import json
+import hashlib
+import numbers
+import threading
+import time
+from collections import OrderedDict
+
+from doc_payload import load_payload, needs_migration
 
 # ==========================================
 # 1. ตั้งค่าการเชื่อมต่อ Supabase
@@ -28,78 +35,393 @@ def get_thai_time():
     return datetime.now(tz_th)
 
 # ==========================================
-# 2. ฟังก์ชันโหลดข้อมูล
+# 2. แคชตารางกลางระดับโปรเซส (ทุก session ใช้ข้อมูลชุดเดียวกัน)
 # ==========================================
-def load_data():
-    if "db_customers" not in st.session_state:
-        try:
-            response = supabase.table(CUST_FILE).select("*").order("id").execute()
-            temp_df = pd.DataFrame(response.data)
-            
-            required_cols = ["id", "ลบ", "รหัส", "ชื่อบริษัท", "ผู้ติดต่อ", "ที่อยู่", "โทร"]
-            if temp_df.empty:
-                temp_df = pd.DataFrame(columns=required_cols)
-            else:
-                for col in required_cols:
-                    if col not in temp_df.columns:
-                        temp_df[col] = ""
-                        
-            temp_df = temp_df.fillna("")
-            st.session_state.db_customers = temp_df
-        except Exception as e:
-            st.error(f"โหลดข้อมูลลูกค้าไม่สำเร็จ: {e}")
-            st.session_state.db_customers = pd.DataFrame(columns=["ลบ", "รหัส", "ชื่อบริษัท", "ผู้ติดต่อ", "ที่อยู่", "โทร"])
+# อายุแคชของแต่ละตาราง (วินาที) หมดอายุแล้วจะดึงจาก Supabase ใหม่
+CACHE_TTL_SECONDS = int(os.environ.get("TABLE_CACHE_TTL", 300))
+# ระหว่างนี้จะดึงเฉพาะแถวที่เปลี่ยน (delta) ครบรอบแล้วดึงทั้งตารางใหม่เพื่อเก็บแถวที่ถูกลบ
+FULL_RECONCILE_SECONDS = int(os.environ.get("TABLE_FULL_SYNC_INTERVAL", 1800))
+# คอลัมน์ที่ใช้เป็น watermark เรียงตามลำดับความสำคัญ (updated_at จับได้ทั้งแถวใหม่และแถวที่แก้ไข)
+WATERMARK_COLUMNS = ["updated_at", "id"]
+# ลบทีละกี่ id ต่อหนึ่ง request (กัน URL ของ in_() ยาวเกิน)
+DELETE_CHUNK_SIZE = int(os.environ.get("DELETE_CHUNK_SIZE", 200))
+# SOFT_DELETE=1 จะติ๊ก ลบ=True ไว้ก่อน (tombstone) แล้วค่อยล้างจริงด้วย compact_tombstones()
+SOFT_DELETE = os.environ.get("SOFT_DELETE", "0") == "1"
 
-    if "db_products" not in st.session_state:
-        try:
-            response = supabase.table(PROD_FILE).select("*").order("id").execute()
-            temp_df = pd.DataFrame(response.data)
-            
-            required_cols = ["id", "ลบ", "รหัสสินค้า", "รายการ", "ราคา", "หน่วย"]
-            if temp_df.empty:
-                temp_df = pd.DataFrame(columns=required_cols)
-            else:
-                for col in required_cols:
-                    if col not in temp_df.columns:
-                        temp_df[col] = ""
-            
-            temp_df = temp_df.fillna("")
-            st.session_state.db_products = temp_df
-        except Exception as e:
-            st.error(f"โหลดข้อมูลสินค้าไม่สำเร็จ: {e}")
-            st.session_state.db_products = pd.DataFrame(columns=["ลบ", "รหัสสินค้า", "รายการ", "ราคา", "หน่วย"])
+TABLE_COLUMNS = {
+    CUST_FILE: ["id", "ลบ", "รหัส", "ชื่อบริษัท", "ผู้ติดต่อ", "ที่อยู่", "โทร"],
+    PROD_FILE: ["id", "ลบ", "รหัสสินค้า", "รายการ", "ราคา", "หน่วย"],
+    HISTORY_FILE: ["id", "ลบ", "date", "doc_no", "c_name", "total"],
+}
 
-    if "db_history" not in st.session_state:
-        try:
-            response = supabase.table(HISTORY_FILE).select("*").order("id").execute()
-            temp_df = pd.DataFrame(response.data)
-            
-            required_cols = ["id", "ลบ", "date", "doc_no", "c_name", "total", "data_json"]
-            if temp_df.empty:
-                temp_df = pd.DataFrame(columns=required_cols)
+# ตารางที่โหลดเฉพาะคอลัมน์สรุป ไม่ดึง data_json ของทุกเอกสารมาทุก session
+# payload ดึงทีละใบตอนใช้จริง (load_history_payloads) ผ่าน LRU ขนาด PAYLOAD_CACHE_SIZE
+SUMMARY_COLUMNS = {
+    HISTORY_FILE: ["id", "ลบ", "date", "doc_no", "c_name", "total", "updated_at"],
+}
+# คอลัมน์สรุปที่ฐานข้อมูลเก่าอาจยังไม่มี (ยังไม่ได้รัน supabase_schema.sql) ถ้าขอแล้ว error จะตัดออกแล้วขอใหม่
+OPTIONAL_SUMMARY_COLUMNS = ("updated_at",)
+PAYLOAD_CACHE_SIZE = int(os.environ.get("PAYLOAD_CACHE_SIZE", 64))
+# ดึง data_json ทีละกี่ใบต่อหนึ่ง request (กัน URL ของ in_() และ response ใหญ่เกิน)
+FETCH_CHUNK_SIZE = int(os.environ.get("FETCH_CHUNK_SIZE", 200))
+
+# ชื่อตัวแปรใน session_state -> ตาราง
+SESSION_TABLES = {
+    "db_customers": CUST_FILE,
+    "db_products": PROD_FILE,
+    "db_history": HISTORY_FILE,
+}
+
+LOAD_ERROR_LABELS = {
+    CUST_FILE: "โหลดข้อมูลลูกค้าไม่สำเร็จ",
+    PROD_FILE: "โหลดข้อมูลสินค้าไม่สำเร็จ",
+    HISTORY_FILE: "โหลดข้อมูลประวัติเอกสารไม่สำเร็จ",
+}
+
+class TableCache:
+    # เก็บ DataFrame ของแต่ละตารางไว้ชุดเดียวต่อโปรเซส ทุก session อ้างอิงตัวเดียวกัน
+    # ⚠️ DataFrame ที่ได้จากแคชห้ามแก้ไขแบบ in-place ให้ .copy() ก่อนแก้เสมอ
+    def __init__(self, ttl=CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _is_fresh(self, entry):
+        return entry is not None and (time.monotonic() - entry["loaded_at"]) < self.ttl
+
+    def get(self, table_name, loader):
+        # ล็อกระหว่างโหลด เพื่อให้ session ที่เปิดพร้อมกันรอผลรอบเดียว ไม่ยิง Supabase ซ้ำ
+        with self._lock:
+            entry = self._entries.get(table_name)
+            if self._is_fresh(entry):
+                self.hits += 1
+                return entry["df"]
+            self.misses += 1
+            return self.refresh(table_name, loader)
+
+    def refresh(self, table_name, loader):
+        # loader(table_name, entry เดิม) คืนค่า (df, is_full, watermark) ถ้า df เป็น None แปลว่าข้อมูลไม่เปลี่ยน
+        with self._lock:
+            entry = self._entries.get(table_name)
+            df, is_full, watermark = loader(table_name, entry)
+            if df is None and entry is not None:
+                entry["loaded_at"] = time.monotonic()
+                return entry["df"]
+            self.put(table_name, df, full=is_full, watermark=watermark)
+            return df
+
+    def put(self, table_name, df, full=True, watermark=None):
+        # watermark = (คอลัมน์, ค่า) ของแถวล่าสุดที่ดึงมาจากเซิร์ฟเวอร์ ใช้เป็นจุดเริ่มของ delta sync ครั้งถัดไป
+        # แถวที่ merge เองในเครื่อง (full=False ไม่ส่ง watermark) ไม่เลื่อน watermark
+        # ไม่งั้นแถวที่ session อื่นเขียนก่อนหน้าแต่ updated_at เก่ากว่าจะไม่ถูกดึงมาเลย
+        with self._lock:
+            old = self._entries.get(table_name)
+            if watermark is None:
+                watermark = old["watermark"] if (old is not None and not full) else _watermark(df)
+            now = time.monotonic()
+            self._entries[table_name] = {
+                "df": df,
+                "loaded_at": now,
+                "full_synced_at": now if (full or old is None) else old["full_synced_at"],
+                "version": (old["version"] + 1) if old else 1,
+                "watermark": watermark,
+                "derived": {},
+            }
+
+    def update(self, table_name, fn):
+        # อ่าน-แก้-เขียน DataFrame ในแคชภายใต้ lock เดียว สอง session ที่บันทึก/ลบพร้อมกันจะไม่ทับแถวของกันและกัน
+        # fn(df ในแคช หรือ None ถ้ายังไม่เคยโหลด) คืน DataFrame ใหม่ ถ้ายังไม่มีในแคชจะไม่เก็บ (ครั้งหน้าโหลดเต็มเอง)
+        with self._lock:
+            entry = self._entries.get(table_name)
+            if entry is None:
+                return fn(None)
+            df = fn(entry["df"])
+            self.put(table_name, df, full=False)
+            return df
+
+    def invalidate(self, table_name=None):
+        with self._lock:
+            if table_name is None:
+                self._entries.clear()
             else:
-                for col in required_cols:
-                    if col not in temp_df.columns:
-                        temp_df[col] = ""
-                        
-            if not temp_df.empty and 'data_json' in temp_df.columns:
-                temp_df['data_json'] = temp_df['data_json'].apply(lambda x: json.dumps(x) if isinstance(x, dict) else x)
-                
-            temp_df = temp_df.fillna("")
-            st.session_state.db_history = temp_df
-        except Exception as e:
-            st.error(f"โหลดข้อมูลประวัติเอกสารไม่สำเร็จ: {e}")
-            st.session_state.db_history = pd.DataFrame(columns=["ลบ", "date", "doc_no", "c_name", "total", "data_json"])
+                self._entries.pop(table_name, None)
+
+    def current(self, table_name):
+        with self._lock:
+            entry = self._entries.get(table_name)
+            return entry["df"] if entry else None
+
+    def version(self, table_name):
+        with self._lock:
+            entry = self._entries.get(table_name)
+            return entry["version"] if entry else 0
+
+    def derived(self, table_name, name, builder):
+        # ค่าที่คำนวณจาก DataFrame ในแคช (เช่น index) คำนวณครั้งเดียวต่อเวอร์ชันของตาราง
+        with self._lock:
+            entry = self._entries.get(table_name)
+            if entry is None:
+                return builder(None)
+            if name not in entry["derived"]:
+                entry["derived"][name] = builder(entry["df"])
+            return entry["derived"][name]
+
+@st.cache_resource
+def get_table_cache():
+    return TableCache()
+
+def _normalize_table(table_name, temp_df):
+    required_cols = TABLE_COLUMNS[table_name]
+    if temp_df.empty:
+        temp_df = pd.DataFrame(columns=required_cols)
+    else:
+        for col in required_cols:
+            if col not in temp_df.columns:
+                temp_df[col] = ""
+
+    if table_name == HISTORY_FILE and not temp_df.empty and 'data_json' in temp_df.columns:
+        # เก็บเป็น dict (รูปแบบ v2) ในหน่วยความจำเลย ไม่แปลงเป็น string แล้วให้แอป json.loads ซ้ำ
+        temp_df['data_json'] = temp_df['data_json'].map(load_payload)
+
+    return temp_df.fillna("")
+
+def _is_marked_deleted(val):
+    return str(val).strip().lower() in ("true", "1")
+
+def marked_deleted(df):
+    # แถวที่ติ๊ก "ลบ" (ค่า NULL / "" / "false" = ไม่ได้ติ๊ก) ใช้เกณฑ์เดียวกับ _is_marked_deleted
+    if 'ลบ' not in df.columns:
+        return pd.Series(False, index=df.index)
+    return df['ลบ'].map(_is_marked_deleted).astype(bool)
+
+def _drop_tombstones(df):
+    # แถวที่ถูก soft-delete (ลบ = True) ไม่ต้องแสดงในแอป
+    if df.empty or 'ลบ' not in df.columns:
+        return df
+    mask = marked_deleted(df)
+    return df[~mask].reset_index(drop=True) if mask.any() else df
+
+# table_name -> set ของคอลัมน์สรุปที่รู้แล้วว่าไม่มีในฐานข้อมูล
+_missing_columns = {}
+
+def _select_columns(table_name):
+    if table_name not in SUMMARY_COLUMNS:
+        return "*"
+    missing = _missing_columns.get(table_name, set())
+    return ", ".join(c for c in SUMMARY_COLUMNS[table_name] if c not in missing)
+
+def _fetch_table(table_name):
+    try:
+        response = supabase.table(table_name).select(_select_columns(table_name)).order("id").execute()
+    except Exception as e:
+        # ไม่มี updated_at = ทั้ง request error ขอใหม่โดยไม่มีคอลัมน์นั้น แล้ว _watermark จะถอยไปใช้ id เอง
+        missing = _missing_columns.setdefault(table_name, set())
+        absent = [c for c in OPTIONAL_SUMMARY_COLUMNS
+                  if c in SUMMARY_COLUMNS.get(table_name, []) and c not in missing and c in str(e)]
+        if not absent:
+            raise
+        missing.update(absent)
+        response = supabase.table(table_name).select(_select_columns(table_name)).order("id").execute()
+    return _drop_tombstones(_normalize_table(table_name, pd.DataFrame(response.data)))
+
+def _watermark(df):
+    for col in WATERMARK_COLUMNS:
+        if col in df.columns:
+            values = df[col][df[col].astype(str).str.strip() != ""]
+            if not values.empty:
+                return col, values.max()
+    return None, None
+
+def _merge_rows(base_df, changes_df):
+    # แถวที่มี id ซ้ำให้ใช้ของใหม่จาก delta แทน
+    kept = base_df[~base_df['id'].isin(changes_df['id'].tolist())]
+    merged = pd.concat([kept, changes_df], ignore_index=True)
+    return merged.sort_values("id", kind="stable").reset_index(drop=True).fillna("")
+
+def _sync_table(table_name, entry, after_write=False, deleted_ids=()):
+    # ⭐ Delta sync: ดึงเฉพาะแถวที่ใหม่กว่า watermark แล้วรวมเข้ากับ DataFrame เดิมในแคช
+    if entry is None or (time.monotonic() - entry["full_synced_at"]) >= FULL_RECONCILE_SECONDS:
+        return _fetch_table(table_name), True, None
+
+    base_df = entry["df"]
+    if len(deleted_ids) > 0:
+        # delta มองไม่เห็นแถวที่ถูกลบ แถวที่เราเพิ่งลบเองให้ตัดออกจากแคชตรงๆ
+        base_df = base_df[~base_df['id'].isin(list(deleted_ids))].reset_index(drop=True)
+    col, mark = entry["watermark"]
+    # ตารางที่ไม่มี updated_at ใช้ id ได้แค่จับแถวใหม่ หลังบันทึก (มีการแก้แถวเดิม) ต้องดึงทั้งตาราง
+    if col is None or (after_write and col == "id"):
+        return _fetch_table(table_name), True, None
+
+    query = supabase.table(table_name).select(_select_columns(table_name))
+    if col == "id":
+        query = query.gt("id", int(float(mark)))
+    else:
+        # updated_at อาจซ้ำกันได้หลายแถว ใช้ >= แล้วให้ _merge_rows ตัดแถวซ้ำด้วย id
+        query = query.gte(col, mark)
+    response = query.order(col).execute()
+    changes_df = _normalize_table(table_name, pd.DataFrame(response.data))
+
+    if changes_df.empty:
+        return (None, False, None) if base_df is entry["df"] else (base_df, False, None)
+    new_col, new_mark = _watermark(changes_df)
+    watermark = (col, max(mark, new_mark)) if new_col == col else None
+    merged = _drop_tombstones(_merge_rows(base_df, changes_df))
+    if base_df is entry["df"] and len(merged) == len(base_df) and merged.equals(base_df):
+        entry["watermark"] = watermark or entry["watermark"]
+        return None, False, None
+    return merged, False, watermark
+
+def _sync_after_write(deleted_ids=()):
+    def loader(table_name, entry):
+        return _sync_table(table_name, entry, after_write=True, deleted_ids=deleted_ids)
+    return loader
 
 # ==========================================
-# 3. ฟังก์ชันบันทึกข้อมูล
+# 3. ฟังก์ชันโหลดข้อมูล
 # ==========================================
-def save_data(df_to_save, table_name, key_col=None):
+def load_data():
+    cache = get_table_cache()
+    for state_key, table_name in SESSION_TABLES.items():
+        if state_key not in st.session_state:
+            try:
+                st.session_state[state_key] = cache.get(table_name, _sync_table)
+                _remember_snapshot(table_name, st.session_state[state_key])
+            except Exception as e:
+                st.error(f"{LOAD_ERROR_LABELS[table_name]}: {e}")
+                st.session_state[state_key] = pd.DataFrame(columns=TABLE_COLUMNS[table_name][1:])
+
+class PayloadCache:
+    # LRU ของ data_json ตาม (id, updated_at) เอกสารที่ถูกบันทึกทับได้ updated_at ใหม่ จึงไม่ได้ค่าเก่า
+    # ⚠️ payload ที่ได้ใช้ร่วมกันทุก session ห้ามแก้ไขแบบ in-place
+    def __init__(self, maxsize=PAYLOAD_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, key, payload):
+        with self._lock:
+            self._entries[key] = payload
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+@st.cache_resource
+def get_payload_cache():
+    return PayloadCache()
+
+def _payload_key(row):
+    return _parse_id(row.get('id')), str(row.get('updated_at') or row.get('date') or "")
+
+def load_history_payloads(rows):
+    # rows = DataFrame แถวประวัติ (คอลัมน์สรุป) คืน list ของ data_json (v2) เรียงตามแถว
+    # ใบที่ยังไม่อยู่ในแคชดึงจาก Supabase รวมเป็น request เดียวต่อ FETCH_CHUNK_SIZE ใบ
+    cache = get_payload_cache()
+    keys = [_payload_key(r) for r in rows.to_dict(orient='records')]
+    found = {k: cache.get(k) for k in keys}
+    key_by_id = {k[0]: k for k, payload in found.items() if payload is None and k[0] is not None}
+    ids = sorted(key_by_id)
+    for start in range(0, len(ids), FETCH_CHUNK_SIZE):
+        chunk = ids[start:start + FETCH_CHUNK_SIZE]
+        response = supabase.table(HISTORY_FILE).select("id, data_json").in_("id", chunk).execute()
+        for rec in response.data or []:
+            key = key_by_id.get(_parse_id(rec.get('id')))
+            if key is not None:
+                found[key] = load_payload(rec.get('data_json'))
+                cache.put(key, found[key])
+    missing = [str(doc) for doc, k in zip(rows['doc_no'], keys) if not isinstance(found[k], dict)]
+    if missing:
+        raise ValueError(f"ไม่พบข้อมูลของเอกสาร {', '.join(missing)}")
+    return [found[k] for k in keys]
+
+def load_history_payload(row):
+    # row = แถวประวัติ 1 แถว (Series)
+    return load_history_payloads(row.to_frame().T)[0]
+
+# ==========================================
+# 4. ฟังก์ชันบันทึกข้อมูล
+# ==========================================
+# คอลัมน์ที่ไม่นำมาเทียบว่าแถวเปลี่ยนหรือไม่ (ฐานข้อมูล/ระบบเป็นคนกำหนดค่าเอง)
+DIFF_IGNORE_COLS = {"id", "updated_at", "created_at"}
+DIFF_IGNORE_COLS_BY_TABLE = {HISTORY_FILE: {"date"}}
+
+def _remember_snapshot(table_name, df):
+    # เก็บ "ข้อมูลชุดที่ session นี้เห็นล่าสุด" ไว้เทียบตอนบันทึก (เก็บแค่ reference ไม่ได้ copy)
+    st.session_state.setdefault("db_snapshots", {})[table_name] = df
+
+def _norm_cell(col, val):
+    if col == 'ลบ':
+        return _is_marked_deleted(val)
+    if isinstance(val, bool):
+        return val
+    if isinstance(val, numbers.Number):
+        return "" if pd.isna(val) else f"{float(val):.10g}"
+    if col == 'data_json' and isinstance(val, str):
+        try:
+            val = json.loads(val)
+        except:
+            return val
+    if isinstance(val, (dict, list)):
+        return json.dumps(val, ensure_ascii=False, sort_keys=True, default=str)
+    return "" if val is None else str(val)
+
+def _row_hash(record, cols):
+    payload = json.dumps([_norm_cell(c, record.get(c, "")) for c in cols], ensure_ascii=False, default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+def _parse_id(val):
+    try:
+        if pd.isna(val) or val == "":
+            return None
+        return int(float(val))
+    except:
+        return None
+
+def _snapshot_hashes(table_name, snapshot_df, cols):
+    # hash ต่อแถว (key = id) ของข้อมูลที่โหลดมาล่าสุด ถ้าเป็นชุดเดียวกับในแคชกลางจะคำนวณครั้งเดียวต่อเวอร์ชัน
+    def build(df):
+        if df is None or 'id' not in df.columns:
+            return {}
+        hashes = {}
+        for r in df.fillna("").to_dict(orient='records'):
+            row_id = _parse_id(r.get('id'))
+            if row_id is not None:
+                hashes[row_id] = _row_hash(r, cols)
+        return hashes
+
+    cache = get_table_cache()
+    if cache.current(table_name) is snapshot_df:
+        return cache.derived(table_name, ("row_hashes", tuple(cols)), build)
+    return build(snapshot_df)
+
+def save_data(df_to_save, table_name, key_col=None, return_stats=False, delete_missing=False):
+    # ⭐ บันทึกแบบ diff: เทียบกับข้อมูลชุดล่าสุดที่โหลดมา แล้วส่งเฉพาะแถวที่เพิ่ม/แก้ จริงเท่านั้น
+    # delete_missing=True (ส่งมาทั้งตารางจาก data_editor) แถวที่เคยโหลดมาแต่ไม่อยู่ใน df_to_save = ผู้ใช้ลบแถวออก ลบที่ฐานข้อมูลด้วย
+    # ค่าเริ่มต้นไม่ลบอะไรเลย df_to_save เป็นแค่บางแถวก็ได้
+    # return_stats=True จะคืนค่า (DataFrame, {"inserted", "updated", "deleted", "written"})
     df = df_to_save.copy()
     
     if 'ลบ' not in df.columns:
         df['ลบ'] = False
 
+    # id ทุกแถวที่ผู้ใช้ยังเก็บไว้ (รวมแถวที่คีย์ว่าง ซึ่งแค่ไม่บันทึก ไม่ได้ตั้งใจลบ)
+    kept_ids = set()
+    if 'id' in df.columns:
+        kept_ids = {i for i in df['id'].map(_parse_id) if i is not None}
+
     if key_col and key_col in df.columns:
         df = df[df[key_col].astype(str).str.strip() != ""]
 
@@ -110,61 +432,74 @@ def save_data(df_to_save, table_name, key_col=None):
         # 1. ถ้าส่งข้อมูลซ้ำมาในรอบเดียว ให้ตัดทิ้งเก็บแค่อันสุดท้าย (ล่าสุด)
         df = df.drop_duplicates(subset=['doc_no'], keep='last')
         
-        # 2. ไปเช็กในฐานข้อมูลว่ามี doc_no นี้อยู่แล้วไหม ถ้ามีให้จำ id เดิมไว้
-        try:
-            existing_db = supabase.table(HISTORY_FILE).select("id, doc_no").execute()
-            doc_map = {str(row['doc_no']).strip(): row['id'] for row in existing_db.data if 'doc_no' in row and 'id' in row}
-        except:
-            doc_map = {}
+        # 2. ใช้ doc_no -> id จากแคชกลางแทนการ select ทั้งตาราง (doc_no ที่ไม่รู้จักจะ upsert ด้วย on_conflict="doc_no")
+        known_df = get_table_cache().current(HISTORY_FILE)
+        doc_map = {}
+        if known_df is not None and not known_df.empty:
+            doc_map = {str(k).strip(): v for k, v in zip(known_df['doc_no'], known_df['id'])}
     else:
         doc_map = {}
 
     df = df.fillna("")
+    ignore_cols = DIFF_IGNORE_COLS | DIFF_IGNORE_COLS_BY_TABLE.get(table_name, set())
+    hash_cols = [c for c in df.columns if c not in ignore_cols]
+
+    snapshot_df = st.session_state.get("db_snapshots", {}).get(table_name)
+    old_hashes = _snapshot_hashes(table_name, snapshot_df, hash_cols) if snapshot_df is not None else {}
+
     records = df.to_dict(orient='records')
     
     existing_records = []
     new_records = []
     
     for r in records:
+        row_hash = _row_hash(r, hash_cols)
+
         # =========================================================
         # จัดการข้อมูลสำหรับตารางประวัติเอกสารโดยเฉพาะ
         # =========================================================
         if table_name == HISTORY_FILE:
-            # 1. อัปเดตเวลาตอนเซฟให้เป็น "เวลาประเทศไทยล่าสุดเสมอ" 
+            # ⭐️ ถ้า doc_no ของเอกสารใบนี้ มีในฐานข้อมูลอยู่แล้ว ให้ใช้ 'id' เดิม 
+            # (เพื่อให้ฐานข้อมูลรู้ว่าต้อง อัปเดตทับ ไม่ใช่ สร้างใหม่)
+            if 'doc_no' in r and str(r['doc_no']).strip() in doc_map:
+                r['id'] = doc_map[str(r['doc_no']).strip()]
+
+        # =========================================================
+        # แยกกลุ่มข้อมูลเพื่อทำ Insert (ของใหม่) และ Upsert (ของเดิม) ข้ามแถวที่ไม่เปลี่ยน
+        # =========================================================
+        row_id = _parse_id(r.get('id'))
+        if row_id is not None:
+            kept_ids.add(row_id)
+        if row_id is not None and old_hashes.get(row_id) == row_hash:
+            continue
+
+        if table_name == HISTORY_FILE:
+            # อัปเดตเวลาตอนเซฟให้เป็น "เวลาประเทศไทยล่าสุดเสมอ" (เฉพาะแถวที่เปลี่ยนจริง)
             r['date'] = get_thai_time().strftime('%Y-%m-%d %H:%M:%S')
 
-            # 2. คืนค่า JSON สำหรับโครงสร้างใบเสนอราคา
+            # คืนค่า JSON สำหรับโครงสร้างใบเสนอราคา
             if 'data_json' in r:
                 if isinstance(r['data_json'], str):
                     try:
                         r['data_json'] = json.loads(r['data_json'])
                     except:
                         pass
-                        
-            # 3. ⭐️ ถ้า doc_no ของเอกสารใบนี้ มีในฐานข้อมูลอยู่แล้ว ให้ใช้ 'id' เดิม 
-            # (เพื่อให้ฐานข้อมูลรู้ว่าต้อง อัปเดตทับ ไม่ใช่ สร้างใหม่)
-            if 'doc_no' in r and str(r['doc_no']).strip() in doc_map:
-                r['id'] = doc_map[str(r['doc_no']).strip()]
-                    
-        # =========================================================
-        # แยกกลุ่มข้อมูลเพื่อทำ Insert (ของใหม่) และ Upsert (ของเดิม)
-        # =========================================================
-        has_valid_id = False
-        if 'id' in r:
-            if pd.isna(r['id']) or r['id'] == "":
-                del r['id']
-            else:
-                try:
-                    r['id'] = int(float(r['id']))
-                    has_valid_id = True
-                except:
-                    del r['id']
-        
-        if has_valid_id:
+
+        for col in DIFF_IGNORE_COLS - {"id"}:
+            r.pop(col, None)
+
+        if row_id is not None:
+            r['id'] = row_id
             existing_records.append(r)
         else:
+            r.pop('id', None)
             new_records.append(r)
 
+    # แถวที่เคยโหลดมาแต่ผู้ใช้เอาออกจากตารางแล้ว = ต้องลบที่ฐานข้อมูลด้วย
+    deleted_ids = sorted(set(old_hashes) - kept_ids) if delete_missing else []
+    stats = {"inserted": len(new_records), "updated": len(existing_records), "deleted": len(deleted_ids)}
+    stats["written"] = stats["inserted"] + stats["updated"] + stats["deleted"]
+
     try:
         # บันทึกข้อมูลแบบอัปเดตทับของเดิม (สำหรับอันที่มี id แล้ว)
         if len(existing_records) > 0:
@@ -172,24 +507,138 @@ def save_data(df_to_save, table_name, key_col=None):
             
         # บันทึกข้อมูลแถวใหม่ (สำหรับอันที่เพิ่งสร้าง)
         if len(new_records) > 0:
-            supabase.table(table_name).insert(new_records).execute()
+            if table_name == HISTORY_FILE:
+                supabase.table(table_name).upsert(new_records, on_conflict="doc_no").execute()
+            else:
+                supabase.table(table_name).insert(new_records).execute()
+
+        if len(deleted_ids) > 0:
+            _delete_ids(table_name, deleted_ids)
             
-        # ดึงข้อมูลกลับมาแสดงผล
-        response = supabase.table(table_name).select("*").order("id").execute()
-        latest_df = pd.DataFrame(response.data)
-        
-        if table_name == HISTORY_FILE and 'data_json' in latest_df.columns:
-             latest_df['data_json'] = latest_df['data_json'].apply(lambda x: json.dumps(x) if isinstance(x, dict) else x)
-             
-        latest_df = latest_df.fillna("")
-        return latest_df
+        # ดึงข้อมูลกลับมาแสดงผล แล้วอัปเดตแคชกลางให้ทุก session เห็นข้อมูลล่าสุด
+        if stats["written"] > 0:
+            latest_df = get_table_cache().refresh(table_name, _sync_after_write(deleted_ids))
+        else:
+            latest_df = snapshot_df if snapshot_df is not None else df
+        _remember_snapshot(table_name, latest_df)
+        return (latest_df, stats) if return_stats else latest_df
         
     except Exception as e:
+        # ไม่แน่ใจว่าฝั่งฐานข้อมูลเขียนไปถึงไหน ให้ทิ้งแคชแล้วโหลดใหม่รอบหน้า
+        get_table_cache().invalidate(table_name)
         st.error(f"เกิดข้อผิดพลาดในการบันทึกข้อมูลตาราง {table_name}: {e}")
-        return df
+        return (df, {"inserted": 0, "updated": 0, "deleted": 0, "written": 0}) if return_stats else df
+
+def save_history_doc(record, return_saved=False):
+    # ⭐ บันทึกเอกสาร 1 ใบด้วย request เดียว: upsert ชน unique doc_no แล้วรับกลับเฉพาะแถวที่เขียน
+    # (ต้องมี unique constraint ของ doc_no ดู supabase_schema.sql) คืนค่า DataFrame ประวัติล่าสุด
+    # return_saved=True จะคืนค่า (DataFrame, บันทึกสำเร็จหรือไม่) ใช้ตัดสินว่าจะเก็บ PDF เข้าคลังได้ไหม
+    r = dict(record)
+    r['doc_no'] = str(r.get('doc_no', '')).strip()
+    r['date'] = get_thai_time().strftime('%Y-%m-%d %H:%M:%S')
+    r.setdefault('ลบ', False)
+    if isinstance(r.get('data_json'), str):
+        try:
+            r['data_json'] = json.loads(r['data_json'])
+        except:
+            pass
+
+    cache = get_table_cache()
+    try:
+        response = supabase.table(HISTORY_FILE).upsert(r, on_conflict="doc_no").execute()
+    except Exception as e:
+        cache.invalidate(HISTORY_FILE)
+        st.error(f"เกิดข้อผิดพลาดในการบันทึกข้อมูลตาราง {HISTORY_FILE}: {e}")
+        df = st.session_state.get("db_history", pd.DataFrame(columns=TABLE_COLUMNS[HISTORY_FILE]))
+        return (df, False) if return_saved else df
+
+    written_df = _normalize_table(HISTORY_FILE, pd.DataFrame(response.data))
+    if 'data_json' in written_df.columns:
+        # payload ที่เพิ่งเขียนเก็บเข้า LRU เลย แต่ตารางในแคชเก็บแค่คอลัมน์สรุปเหมือนตอนโหลด
+        payload_cache = get_payload_cache()
+        for rec in written_df.to_dict(orient='records'):
+            payload_cache.put(_payload_key(rec), rec['data_json'])
+        written_df = written_df.drop(columns=['data_json'])
+
+    def merge_written(current_df):
+        if current_df is None:
+            current_df = st.session_state.get("db_history", pd.DataFrame(columns=TABLE_COLUMNS[HISTORY_FILE]))
+        if written_df.empty:
+            return current_df
+        # กันกรณีแถวเดิมใน DataFrame ยังไม่มี id ตรงกัน ให้ตัดด้วย doc_no ด้วย
+        current_df = current_df[~current_df['doc_no'].astype(str).isin(written_df['doc_no'].astype(str).tolist())]
+        return _merge_rows(current_df, written_df)
+
+    current_df = cache.update(HISTORY_FILE, merge_written)
+    _remember_snapshot(HISTORY_FILE, current_df)
+    return (current_df, True) if return_saved else current_df
 
 # ==========================================
-# 4. ฟังก์ชันช่วยเหลืออื่นๆ
+# 5. ฟังก์ชันลบข้อมูล (ลบเป็นชุดตาม id)
+# ==========================================
+def _delete_ids(table_name, ids):
+    for start in range(0, len(ids), DELETE_CHUNK_SIZE):
+        chunk = ids[start:start + DELETE_CHUNK_SIZE]
+        if SOFT_DELETE:
+            supabase.table(table_name).update({"ลบ": True}).in_("id", chunk).execute()
+        else:
+            supabase.table(table_name).delete().in_("id", chunk).execute()
+
+def delete_rows(table_name, ids):
+    # ลบแถวตาม id ที่ผู้ใช้ติ๊ก "ลบ" แล้วตัดแถวเหล่านั้นออกจากแคชกลางและ snapshot ของ session
+    # คืนค่า DataFrame ของตารางหลังลบ
+    ids = sorted({i for i in (_parse_id(v) for v in ids) if i is not None})
+    cache = get_table_cache()
+    current_df = cache.current(table_name)
+    if len(ids) == 0:
+        return current_df if current_df is not None else pd.DataFrame(columns=TABLE_COLUMNS[table_name])
+
+    try:
+        _delete_ids(table_name, ids)
+    except Exception as e:
+        cache.invalidate(table_name)
+        st.error(f"เกิดข้อผิดพลาดในการลบข้อมูลตาราง {table_name}: {e}")
+        return current_df if current_df is not None else pd.DataFrame(columns=TABLE_COLUMNS[table_name])
+
+    def drop_deleted(current_df):
+        if current_df is None:
+            return None
+        return current_df[~current_df['id'].isin(ids)].reset_index(drop=True)
+
+    current_df = cache.update(table_name, drop_deleted)
+    if current_df is None:
+        current_df = cache.get(table_name, _sync_table)
+
+    snapshot_df = st.session_state.get("db_snapshots", {}).get(table_name)
+    if snapshot_df is not None and 'id' in snapshot_df.columns:
+        _remember_snapshot(table_name, snapshot_df[~snapshot_df['id'].isin(ids)])
+    return current_df
+
+def compact_tombstones(table_name):
+    # ล้างแถวที่ถูก soft-delete ออกจากฐานข้อมูลจริง (ใช้คู่กับ SOFT_DELETE=1) คืนค่าจำนวนแถวที่ล้าง
+    try:
+        response = supabase.table(table_name).delete().eq("ลบ", True).execute()
+        return len(response.data or [])
+    except Exception as e:
+        st.error(f"ล้างข้อมูลที่ถูกลบของตาราง {table_name} ไม่สำเร็จ: {e}")
+        return 0
+
+def migrate_history_payloads():
+    # แปลง data_json ของเอกสารเก่า (v1 / string) ในฐานข้อมูลเป็น v2 คืนค่าจำนวนแถวที่แปลง
+    # (ตอนโหลดแปลงในหน่วยความจำให้อยู่แล้ว อันนี้เขียนกลับเพื่อลดขนาดตารางจริง)
+    migrated = 0
+    try:
+        response = supabase.table(HISTORY_FILE).select("id, data_json").order("id").execute()
+        for row in response.data or []:
+            if needs_migration(row.get('data_json')):
+                supabase.table(HISTORY_FILE).update({"data_json": load_payload(row['data_json'])}).eq("id", row['id']).execute()
+                migrated += 1
+    except Exception as e:
+        st.error(f"แปลงข้อมูลตาราง {HISTORY_FILE} ไม่สำเร็จ: {e}")
+    return migrated
+
+# ==========================================
+# 6. ฟังก์ชันช่วยเหลืออื่นๆ
 # ==========================================
 def to_int(val):
     try:
@@ -198,29 +647,104 @@ def to_int(val):
     except:
         return 0
 
+def _build_product_index(prod_df):
+    # รหัสสินค้า (ตัวพิมพ์เล็ก) -> ข้อมูลสินค้า ถ้ารหัสซ้ำใช้แถวแรกเหมือนการค้นหาแบบเดิม
+    if prod_df is None or prod_df.empty or 'รหัสสินค้า' not in prod_df.columns:
+        return {}
+    codes = prod_df['รหัสสินค้า'].astype(str).str.strip().str.lower()
+    cols = [c for c in ["รหัสสินค้า", "รายการ", "หน่วย", "ราคา"] if c in prod_df.columns]
+    index = {}
+    for code, rec in zip(codes, prod_df[cols].to_dict(orient='records')):
+        if code and code not in index:
+            index[code] = rec
+    return index
+
+def get_product_index(prod_df):
+    # ⭐ hash index สำหรับเติมข้อมูลสินค้าจากรหัส สร้างครั้งเดียวต่อเวอร์ชันของแคตตาล็อก
+    cache = get_table_cache()
+    if prod_df is not None and cache.current(PROD_FILE) is prod_df:
+        return cache.derived(PROD_FILE, "product_index", _build_product_index)
+    # DataFrame ของ session ที่ไม่ใช่ตัวในแคช (เช่นโหลดไม่สำเร็จ) ให้จำ index ไว้กับ DataFrame นั้น
+    memo = st.session_state.get("product_index_memo")
+    if memo is None or memo[0] is not prod_df:
+        memo = (prod_df, _build_product_index(prod_df))
+        st.session_state.product_index_memo = memo
+    return memo[1]
+
+def _doc_prefix(prefix_type):
+    # ⭐️ เลขเอกสารอิงตามวันที่ของประเทศไทย เช่น QT-20240131
+    return f"{prefix_type}-{get_thai_time().strftime('%Y%m%d')}"
+
+def _build_doc_no_index(hist_df):
+    # prefix (เช่น QT-20240131) -> เลขรันสูงสุด คำนวณครั้งเดียวต่อเวอร์ชันของตารางประวัติ
+    if hist_df is None or hist_df.empty or 'doc_no' not in hist_df.columns:
+        return {}
+    parts = hist_df['doc_no'].astype(str).str.strip().str.rsplit("-", n=1, expand=True)
+    if parts.shape[1] < 2:
+        return {}
+    run_no = pd.to_numeric(parts[1], errors="coerce")
+    valid = run_no.notna()
+    if not valid.any():
+        return {}
+    return run_no[valid].groupby(parts[0][valid]).max().astype(int).to_dict()
+
+class DocNoAllocator:
+    # ตัวสำรองเมื่อฐานข้อมูลไม่มี RPC next_doc_no: จองเลขในโปรเซสนี้ภายใต้ lock กันแจกเลขซ้ำระหว่าง session
+    # ⚠️ ไม่ atomic ข้ามโปรเซส/instance ถ้ารันหลาย worker อาจได้เลขซ้ำ ให้รัน supabase_schema.sql
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reserved = {}
+        self.rpc_available = True
+
+    def peek(self, prefix, index):
+        return max(index.get(prefix, 0), self._reserved.get(prefix, 0)) + 1
+
+    def reserve(self, prefix, index, run_no=None):
+        with self._lock:
+            if run_no is None:
+                run_no = self.peek(prefix, index)
+            self._reserved[prefix] = max(run_no, self._reserved.get(prefix, 0))
+            return run_no
+
+@st.cache_resource
+def get_doc_no_allocator():
+    return DocNoAllocator()
+
+def _doc_no_index():
+    cache = get_table_cache()
+    if cache.current(HISTORY_FILE) is not None:
+        return cache.derived(HISTORY_FILE, "doc_no_index", _build_doc_no_index)
+    return _build_doc_no_index(st.session_state.get("db_history"))
+
 def generate_doc_no(prefix_type="QT"):
-    # ⭐️ สร้างเลขเอกสาร โดยอิงตามวันที่ของประเทศไทย
-    today_str = get_thai_time().strftime('%Y%m%d')
-    prefix = f"{prefix_type}-{today_str}"
-    
-    if st.session_state.db_history.empty:
-        return f"{prefix}-001"
-    
-    hist_df = st.session_state.db_history.copy()
-    hist_df['doc_no'] = hist_df['doc_no'].astype(str)
-    
-    today_docs = hist_df[hist_df['doc_no'].str.startswith(prefix, na=False)]
-    
-    if today_docs.empty:
-        return f"{prefix}-001"
-    else:
-        def extract_run_no(doc_str):
-            try:
-                return int(doc_str.split("-")[-1])
-            except:
-                return 0
-                
-        today_docs['run_no'] = today_docs['doc_no'].apply(extract_run_no)
-        max_run = today_docs['run_no'].max()
-        next_run = max_run + 1
-        return f"{prefix}-{next_run:03d}"
+    # เลขถัดไปสำหรับ "แสดงตัวอย่าง" ในหน้าจอ (O(1) ไม่ได้จองเลขจริง) ตอนบันทึกให้ใช้ allocate_doc_no()
+    prefix = _doc_prefix(prefix_type)
+    next_run = get_doc_no_allocator().peek(prefix, _doc_no_index())
+    return f"{prefix}-{next_run:03d}"
+
+# error ของ "ไม่มีฟังก์ชันนี้" (PostgREST PGRST202 / Postgres 42883) = ยังไม่ได้สร้าง next_doc_no
+_MISSING_FUNCTION_CODES = {"PGRST202", "42883"}
+
+def _is_missing_function(e):
+    return str(getattr(e, "code", "") or "") in _MISSING_FUNCTION_CODES or "Could not find the function" in str(e)
+
+def allocate_doc_no(prefix_type="QT"):
+    # ⭐ จองเลขเอกสารแบบ atomic ผ่าน RPC next_doc_no (ตาราง doc_counters ดู supabase_schema.sql)
+    # ใช้ตัวจองในหน่วยความจำแทนเฉพาะเมื่อฐานข้อมูลไม่มีฟังก์ชันนี้ (จำไว้ทั้งโปรเซส ไม่เรียก RPC ซ้ำทุกใบ)
+    # error อื่น (เครือข่าย/สิทธิ์) ส่งต่อให้ผู้เรียก ไม่แอบออกเลขที่อาจซ้ำ
+    prefix = _doc_prefix(prefix_type)
+    allocator = get_doc_no_allocator()
+    if allocator.rpc_available:
+        try:
+            response = supabase.rpc("next_doc_no", {"p_prefix": prefix}).execute()
+        except Exception as e:
+            if not _is_missing_function(e):
+                raise
+            allocator.rpc_available = False
+            st.warning("ฐานข้อมูลยังไม่มีฟังก์ชัน next_doc_no (รัน supabase_schema.sql) ตอนนี้จองเลขเอกสารในโปรเซสนี้แทน ถ้ารันหลาย instance เลขอาจซ้ำได้")
+        else:
+            doc_no = str(response.data).strip()
+            allocator.reserve(prefix, {}, int(doc_no.rsplit("-", 1)[-1]))
+            return doc_no
+    next_run = allocator.reserve(prefix, _doc_no_index())
+    return f"{prefix}-{next_run:03d}"
@@ -0,0 +1,85 @@
+import json
+import math
+
+import pandas as pd
+
+# ==========================================
+# รูปแบบ data_json ของเอกสารใน history_quotes
+# ==========================================
+# v1 (เดิม): "grid_df" = edited_df.to_dict() แบบแยกคอลัมน์ มีแถวว่าง 15 แถว และ key เป็นเลข index ทุกช่อง
+# v2: "items" = list ของแถว [รหัส, รายการ, จำนวน, หน่วย, ราคา, ส่วนลด] เฉพาะแถวที่มีข้อมูล ตัวเลขเก็บเป็นตัวเลข
+# อ่านได้ทั้งสองแบบ (load_payload แปลง v1 เป็น v2 ให้) แต่บันทึกเป็น v2 เสมอ
+PAYLOAD_VERSION = 2
+ITEM_COLUMNS = ["รหัสสินค้า", "รายการ", "จำนวน", "หน่วย", "ราคา", "ส่วนลด"]
+NUMBER_COLUMNS = {"จำนวน", "ราคา", "ส่วนลด"}
+EDITOR_MIN_ROWS = 15
+# ข้อมูลที่ต้องเก็บไว้ครบถึงจะสร้าง PDF ใหม่จาก payload ได้ตรงกับที่ออกไป (ยกเว้นรูปลายเซ็น)
+# payload ที่บันทึกก่อนมีฟิลด์เหล่านี้ไม่มีหัวกระดาษผู้ขาย ไม่รู้ว่าคิด VAT หรือไม่ และไม่มีหมายเหตุ
+RENDER_FIELDS = ("my_comp", "my_addr", "my_tel", "my_tax", "exp_date", "vat", "remark", "s1", "s2")
+
+def _text(val):
+    if val is None or (isinstance(val, float) and math.isnan(val)):
+        return ""
+    text = str(val)
+    return "" if text.lower() == "nan" else text
+
+def _number(val):
+    try:
+        num = float(str(val).replace(",", "")) if isinstance(val, str) else float(val)
+    except:
+        return 0
+    if math.isnan(num) or math.isinf(num):
+        return 0
+    # 2.0 -> 2 ให้ JSON สั้นลง (ตอนอ่านกลับแปลงเป็น float เหมือนเดิม)
+    return int(num) if num.is_integer() else num
+
+def compact_items(items_df):
+    # DataFrame ของตารางสินค้า -> แถวแบบ v2 (ข้ามแถวที่ไม่มีทั้งรหัสและรายการ)
+    if items_df is None or len(items_df) == 0:
+        return []
+    cols = []
+    for col in ITEM_COLUMNS:
+        values = items_df[col].tolist() if col in items_df.columns else [None] * len(items_df)
+        cols.append([_number(v) for v in values] if col in NUMBER_COLUMNS else [_text(v) for v in values])
+    return [list(row) for row in zip(*cols) if row[0].strip() or row[1].strip()]
+
+def items_frame(items, min_rows=0):
+    # แถวแบบ v2 -> DataFrame คอลัมน์เดียวกับตารางในหน้าจอ (min_rows = เติมแถวว่างให้ครบสำหรับ data_editor)
+    rows = [list(r) + [""] * (len(ITEM_COLUMNS) - len(r)) for r in items]
+    rows += [["", "", 0, "", 0, 0]] * max(0, min_rows - len(rows))
+    df = pd.DataFrame(rows, columns=ITEM_COLUMNS)
+    for col in NUMBER_COLUMNS:
+        df[col] = df[col].map(_number).astype(float)
+    return df
+
+def _grid_frame(grid):
+    # key ของแถวใน v1 กลายเป็น string หลังผ่าน JSON ("0", "1", ..., "10") เรียงตามเลขแถวจริงก่อน
+    df = pd.DataFrame.from_dict(grid)
+    try:
+        df.index = df.index.astype(int)
+        df = df.sort_index()
+    except:
+        pass
+    return df
+
+def load_payload(data):
+    # data_json จากฐานข้อมูล (str หรือ dict, v1 หรือ v2) -> dict v2
+    # v2 อยู่แล้วคืนตัวเดิมเลย (ไม่ copy) เรียกซ้ำกี่ครั้งก็ได้
+    if isinstance(data, str):
+        try:
+            data = json.loads(data)
+        except:
+            return data
+    if not isinstance(data, dict) or data.get("v") == PAYLOAD_VERSION:
+        return data
+    payload = {k: v for k, v in data.items() if k != "grid_df"}
+    grid = data.get("grid_df") or {}
+    payload["items"] = compact_items(_grid_frame(grid)) if grid else list(data.get("items", []))
+    payload["v"] = PAYLOAD_VERSION
+    return payload
+
+def needs_migration(data):
+    return isinstance(data, str) or (isinstance(data, dict) and data.get("v") != PAYLOAD_VERSION)
+
+def missing_render_fields(data):
+    return [f for f in RENDER_FIELDS if f not in data]
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import zlib
+from datetime import datetime, timezone
+
+# ==========================================
+# คลัง PDF ของเอกสารที่ออกไปแล้ว (สำเนาตัวจริง)
+# ==========================================
+# history_quotes เก็บแค่ data_json ถ้าพิมพ์ซ้ำด้วยการสร้างใหม่ ไฟล์อาจไม่ตรงกับใบที่ส่งลูกค้า (เทมเพลต/โลโก้เปลี่ยน)
+# ที่นี่เก็บไฟล์ PDF จริงครั้งเดียวแบบ content-addressed (sha256 ของไฟล์) บีบอัดด้วย zlib แล้วผูกกับ doc_no
+# พิมพ์ซ้ำ/ดาวน์โหลด = อ่านครั้งเดียว ไม่ต้องสร้าง PDF ใหม่
+# ตอนนี้มี backend เดียวคือ SQLite ไฟล์เดียว (อนาคตเพิ่ม Supabase Storage ได้ด้วย class ที่มี put/get/has/stats เหมือนกัน)
+PDF_ARCHIVE_PATH = os.environ.get("PDF_ARCHIVE_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "pdf_archive.sqlite3")
+PDF_ARCHIVE_LEVEL = 6
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS issues (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    doc_no TEXT NOT NULL,
+    sha256 TEXT NOT NULL REFERENCES blobs(sha256),
+    archived_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS issues_by_doc ON issues (doc_no, seq);
+"""
+
+# คลังรุ่นแรกเก็บ (doc_no, sha256) ไม่ซ้ำ ไฟล์ที่กลับมาเป็นเวอร์ชันเดิมจึงไม่ถูกนับเป็นฉบับล่าสุด ย้ายเข้า issues ตามลำดับเวลา
+_MIGRATE_DOCS = """
+INSERT INTO issues (doc_no, sha256, archived_at) SELECT doc_no, sha256, archived_at FROM docs ORDER BY archived_at;
+DROP TABLE docs;
+"""
+
+class SQLiteArchive:
+    # ทุกครั้งที่ออกเอกสาร = 1 แถวใน issues (seq เพิ่มขึ้นเรื่อยๆ) get() คืนฉบับที่ออกล่าสุด
+    # QT ที่แก้แล้วเซฟซ้ำเก็บครบทุกครั้ง แม้จะกลับไปเป็นไฟล์เดิม (v1 -> v2 -> v1 ฉบับล่าสุดคือ v1)
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'docs'").fetchone():
+                with conn:
+                    conn.executescript(_MIGRATE_DOCS)
+            self._conn = conn
+        return self._conn
+
+    def put(self, doc_no, pdf_bytes):
+        sha = hashlib.sha256(pdf_bytes).hexdigest()
+        archived_at = datetime.now(timezone.utc).isoformat(timespec="microseconds")
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                exists = conn.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (sha,)).fetchone()
+                if exists is None:
+                    conn.execute(
+                        "INSERT INTO blobs (sha256, size, data) VALUES (?, ?, ?)",
+                        (sha, len(pdf_bytes), zlib.compress(pdf_bytes, PDF_ARCHIVE_LEVEL)),
+                    )
+                # ไม่เพิ่มแถวถ้าฉบับล่าสุดของ doc_no นี้เป็นไฟล์เดียวกันอยู่แล้ว (เช่นกดบันทึกซ้ำโดยไม่แก้อะไร)
+                latest = conn.execute(
+                    "SELECT sha256 FROM issues WHERE doc_no = ? ORDER BY seq DESC LIMIT 1", (str(doc_no),)
+                ).fetchone()
+                if latest is None or latest[0] != sha:
+                    conn.execute(
+                        "INSERT INTO issues (doc_no, sha256, archived_at) VALUES (?, ?, ?)",
+                        (str(doc_no), sha, archived_at),
+                    )
+        return sha
+
+    def get(self, doc_no):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT b.sha256, b.data FROM issues i JOIN blobs b ON b.sha256 = i.sha256 "
+                "WHERE i.doc_no = ? ORDER BY i.seq DESC LIMIT 1",
+                (str(doc_no),),
+            ).fetchone()
+        if row is None:
+            return None
+        pdf_bytes = zlib.decompress(row[1])
+        if hashlib.sha256(pdf_bytes).hexdigest() != row[0]:
+            raise ValueError(f"ไฟล์ในคลังของ {doc_no} เสียหาย (hash ไม่ตรง)")
+        return pdf_bytes
+
+    def has(self, doc_nos):
+        # คืน set ของ doc_no ที่มีไฟล์ในคลังแล้ว
+        doc_nos = [str(d) for d in doc_nos]
+        found = set()
+        with self._lock:
+            conn = self._connect()
+            for i in range(0, len(doc_nos), 500):
+                chunk = doc_nos[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                found.update(r[0] for r in conn.execute(f"SELECT DISTINCT doc_no FROM issues WHERE doc_no IN ({marks})", chunk))
+        return found
+
+    def stats(self):
+        with self._lock:
+            conn = self._connect()
+            docs = conn.execute("SELECT COUNT(DISTINCT doc_no) FROM issues").fetchone()[0]
+            files, raw, stored = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(data)), 0) FROM blobs").fetchone()
+        return {"docs": docs, "files": files, "bytes": raw, "stored_bytes": stored}
+
+_archive = None
+_archive_lock = threading.Lock()
+
+def get_archive():
+    global _archive
+    with _archive_lock:
+        if _archive is None:
+            _archive = SQLiteArchive(PDF_ARCHIVE_PATH)
+        return _archive
+
+def archive_pdf(doc_no, pdf_bytes):
+    # เก็บไม่ได้ (ดิสก์เต็ม/อ่านอย่างเดียว) ไม่ทำให้การออกเอกสารล้ม แค่พิมพ์ซ้ำจะต้องสร้างใหม่
+    try:
+        return get_archive().put(doc_no, pdf_bytes)
+    except (sqlite3.Error, OSError):
+        return None
+
+def archived_pdf(doc_no):
+    try:
+        return get_archive().get(doc_no)
+    except (sqlite3.Error, OSError):
+        return None
+
+def archived_doc_nos(doc_nos):
+    try:
+        return get_archive().has(doc_nos)
+    except (sqlite3.Error, OSError):
+        return set()
+
+def archive_stats():
+    try:
+        return get_archive().stats()
+    except (sqlite3.Error, OSError):
+        return None
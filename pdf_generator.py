@@ -1,19 +1,126 @@
 import os
 import io
+import sys
+import importlib.util
+import json
 import tempfile
-import math
+import copy
+import hashlib
+import threading
+import time
+import zipfile
+from datetime import datetime, timezone
 from fpdf import FPDF
 from bahttext import bahttext 
-from database import to_int
+from pricing import line_amounts, price_items
+from thai_text import wrap_text
+from blob_cache import BlobCache
+from doc_payload import load_payload, items_frame
 
-try:
-    import fitz 
-    from PIL import Image 
-    HAS_IMG_LIB = True
-except ImportError:
-    HAS_IMG_LIB = False
+# PyMuPDF/Pillow ใช้เฉพาะตอนแปลงเป็นรูป import ตอนใช้งานจริง (ไม่ถ่วงเวลา import ของตัวสร้าง PDF)
+HAS_IMG_LIB = importlib.util.find_spec("fitz") is not None and importlib.util.find_spec("PIL") is not None
 
-FONT_PATH = "THSarabunNew.ttf" 
+# ไม่พึ่ง database/streamlit เพื่อให้ import ได้เร็วใน worker process และ CLI (python -m pdf_generator)
+# หาไฟล์ฟอนต์/โลโก้จากโฟลเดอร์ของโมดูล จะได้เรียกจากโฟลเดอร์ไหนก็ได้
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FONT_PATH = os.path.join(BASE_DIR, "THSarabunNew.ttf")
+LOGO_PATH = os.path.join(BASE_DIR, "logo11.jpg")
+
+# ==========================================
+# แคชฟอนต์/รูปที่ parse แล้ว ระดับโปรเซส (ใช้ซ้ำได้ทุกเอกสาร)
+# ==========================================
+_asset_lock = threading.Lock()
+_font_templates = {}   # (path, style) -> (TTFFont ที่ parse แล้ว, bytes ของไฟล์)
+_image_infos = {}      # path -> ข้อมูลรูปที่ decode แล้ว
+
+def _font_template(path, style):
+    key = (path, style)
+    with _asset_lock:
+        if key not in _font_templates:
+            probe = FPDF()
+            probe.add_font('cached', style, path)
+            with open(path, 'rb') as f:
+                font_bytes = f.read()
+            _font_templates[key] = (probe.fonts[f"cached{style}"], font_bytes)
+        return _font_templates[key]
+
+# ส่วนภายในของ TTFFont ที่ _add_cached_font สร้างใหม่ให้แต่ละเอกสาร (ตรวจกับ fpdf2 2.8.9 ที่ pin ไว้ใน requirements.txt)
+_FONT_DOC_STATE = ("i", "fontkey", "desc", "cw", "glyph_ids", "ttfont", "missing_glyphs", "biggest_size_pt", "_hbfont", "subset")
+
+def _add_cached_font(pdf, family, style, path):
+    # คัดลอกฟอนต์ที่ parse ไว้แล้ว แต่ทุกอย่างที่ fpdf แก้ระหว่างสร้าง/output ต้องเป็นของเอกสารนั้นเอง
+    # เพราะหลาย session (หลาย thread) สร้าง PDF พร้อมกันได้:
+    # - ttfont ถูก subset ตอน output, SubsetMap เก็บตัวอักษรที่ใช้ในเอกสาร
+    # - desc ถูกตั้ง id/font_name ตอน output (ใช้ร่วมกันแล้ว object id ของอีกเอกสารจะทับกัน)
+    # - cw เป็น defaultdict (อ่าน key ที่ไม่มีก็เพิ่ม key), glyph_ids/missing_glyphs แยกไว้ด้วย
+    # ใช้ร่วมกันเฉพาะ cmap ที่อ่านอย่างเดียว (fpdf เองก็ใช้ร่วมตอน deepcopy ฟอนต์)
+    from fontTools import ttLib
+    from fpdf.fonts import SubsetMap
+
+    template, font_bytes = _font_template(path, style)
+    missing = [a for a in _FONT_DOC_STATE if not hasattr(template, a)]
+    if missing:
+        raise AttributeError(f"TTFFont ของ fpdf2 เวอร์ชันนี้ไม่มี {', '.join(missing)}")
+    font = copy.copy(template)
+    font.desc = copy.copy(template.desc)
+    font.cw = copy.copy(template.cw)
+    font.glyph_ids = dict(template.glyph_ids)
+    font.i = len(pdf.fonts) + 1
+    font.fontkey = f"{family.lower()}{style}"
+    font.ttfont = ttLib.TTFont(io.BytesIO(font_bytes), recalcTimestamp=False, lazy=True)
+    font.missing_glyphs = []
+    font.biggest_size_pt = 0
+    font._hbfont = None
+    font.subset = SubsetMap(font)
+    pdf.fonts[font.fontkey] = font
+
+def register_fonts(pdf):
+    if not os.path.exists(FONT_PATH):
+        return 'Arial'
+    for style in ['', 'B']:
+        try:
+            _add_cached_font(pdf, 'THSarabun', style, FONT_PATH)
+        except Exception:
+            # fpdf2 เวอร์ชันที่โครงสร้างภายในต่างไป ให้กลับไปใช้ add_font ปกติ
+            pdf.add_font('THSarabun', style, FONT_PATH)
+    return 'THSarabun'
+
+def _image_info(path):
+    from fpdf.image_parsing import get_img_info
+    with _asset_lock:
+        if path not in _image_infos:
+            _image_infos[path] = get_img_info(path)
+        return _image_infos[path]
+
+def preload_image(pdf, path):
+    # ใส่รูปที่ decode แล้วลง image cache ของเอกสาร pdf.image(path) จะไม่ต้องอ่าน/ถอดรหัสไฟล์ซ้ำ
+    if not os.path.exists(path):
+        return
+    try:
+        info = _image_info(path)
+        if info.get("iccp") is not None:
+            return
+        doc_info = copy.copy(info)
+        doc_info["i"] = len(pdf.image_cache.images) + 1
+        doc_info["usages"] = 0
+        doc_info["iccp_i"] = None
+        pdf.image_cache.images[path] = doc_info
+    except Exception:
+        pass
+
+def warm_up():
+    # โหลดฟอนต์และโลโก้เข้าแคชตั้งแต่เปิดแอป คืนค่าเวลาที่ใช้ (วินาที) ของแต่ละรายการ
+    timings = {}
+    if os.path.exists(FONT_PATH):
+        for style in ['', 'B']:
+            t0 = time.perf_counter()
+            _font_template(FONT_PATH, style)
+            timings[f"font{style}"] = time.perf_counter() - t0
+    if os.path.exists(LOGO_PATH):
+        t0 = time.perf_counter()
+        _image_info(LOGO_PATH)
+        timings["logo"] = time.perf_counter() - t0
+    return timings
 
 def to_f(val):
     try:
@@ -22,6 +129,13 @@ def to_f(val):
     except:
         return 0.0
 
+def to_int(val):
+    try:
+        if isinstance(val, str): val = val.replace(',', '')
+        return int(round(float(val))) if val is not None else 0
+    except:
+        return 0
+
 # ✅ FIX 1: กันค่า NaN / None
 def safe_str(val):
     if val is None:
@@ -31,306 +145,167 @@ def safe_str(val):
     return str(val)
 
 # ==========================================
-# PDF ENGINE (dynamic + header repeat + กันชน)
+# วางผังตารางสินค้า (ตัดบรรทัดจริง + ความสูงแถว + ตำแหน่งขึ้นหน้าใหม่) ก่อนวาดจริง
 # ==========================================
-def create_pdf(d, items_df, summary, sigs, remark_text, show_vat_line, doc_title="ใบเสนอราคา (QUOTATION)"):
+COLS_W = [12, 73, 15, 15, 25, 15, 25]
+COL_ALIGNS = ['C', 'L', 'C', 'C', 'C', 'C', 'C']
+LINE_H = 7
+MIN_ROW_H = 8
+TABLE_TOP = 90        # y ของหัวตาราง
+TABLE_HEADER_H = 9
+PAGE_BOTTOM = 250     # เกินจากนี้ขึ้นหน้าใหม่
+SUMMARY_H = 60        # ที่ว่างที่ต้องเหลือไว้สำหรับสรุปยอด
+
+def valid_item_rows(items_df):
+    if 'หน่วย' not in items_df.columns:
+        items_df['หน่วย'] = ""
+    return items_df[items_df['รายการ'].astype(str).str.strip() != ""].copy()
+
+def _text_column(series):
+    # เหมือน safe_str แต่ทำทั้งคอลัมน์: None/NaN/"nan" = ""
+    text = series.astype(object).where(series.notna(), "").astype(str)
+    return text.mask(text.str.lower() == "nan", "").tolist()
+
+def _money_column(values):
+    return [f"{v:,.2f}" for v in values.tolist()]
+
+def item_cells(valid_items):
+    # ข้อความของแต่ละช่องในตาราง เรียงตามคอลัมน์ COLS_W
+    # จัดรูปแบบทีละคอลัมน์แล้วค่อยรวมเป็น tuple ต่อแถว (เร็วกว่า iterrows ที่สร้าง Series ทุกแถว)
+    lines = line_amounts(valid_items)
+    discounts = _money_column(lines['d'])
+    return list(zip(
+        [str(i) for i in range(1, len(valid_items) + 1)],
+        valid_items['รายการ'].astype(str).tolist(),
+        _money_column(lines['q']),
+        _text_column(valid_items['หน่วย']),  # ✅ FIX
+        _money_column(lines['p']),
+        [txt if dis > 0 else "-" for txt, dis in zip(discounts, lines['d'].tolist())],
+        _money_column(lines['total']),
+    ))
+
+def _wrap_cell(pdf, w, txt, align):
+    # ตัดบรรทัดแบบไทย (แคชผลไว้ข้ามเอกสาร) ถ้าเป็นฟอนต์ที่ไม่รองรับให้ fpdf ตัดเอง
+    lines = wrap_text(pdf.current_font, pdf.font_size_pt, (w - 2 * pdf.c_margin) * pdf.k, txt)
+    if lines is None:
+        lines = pdf.multi_cell(w, LINE_H, txt, 0, align, dry_run=True, output="LINES") or [""]
+    return lines
+
+def plan_layout(pdf, cell_rows):
+    # ใช้ฟอนต์ปัจจุบันของ pdf วัดข้อความ (ต้องเป็นฟอนต์เดียวกับตอนวาดตาราง)
+    # คืนค่า: rows = [{'cells', 'h', 'page', 'y'}], breaks = แถวแรกของแต่ละหน้าที่ขึ้นใหม่,
+    # summary_page/summary_y = ตำแหน่งส่วนสรุปยอด, pages = จำนวนหน้าทั้งหมด
+    rows = []
+    breaks = []
+    page = 1
+    y = TABLE_TOP + TABLE_HEADER_H
+    for i, vals in enumerate(cell_rows):
+        cells = [_wrap_cell(pdf, COLS_W[j], txt, COL_ALIGNS[j]) for j, txt in enumerate(vals)]
+        h = max(MIN_ROW_H, LINE_H * max(len(c) for c in cells))
+        if y + h > PAGE_BOTTOM:
+            page += 1
+            y = TABLE_TOP + TABLE_HEADER_H
+            breaks.append(i)
+        rows.append({'cells': cells, 'h': h, 'page': page, 'y': y})
+        y += h
+
+    summary_page = page
+    if y + SUMMARY_H > PAGE_BOTTOM:
+        summary_page += 1
+        y = 15
+    return {'rows': rows, 'breaks': breaks, 'summary_page': summary_page, 'summary_y': y, 'pages': summary_page}
+
+def _measure_pdf():
     pdf = FPDF(unit='mm', format='A4')
     pdf.set_margins(15, 15, 15)
     pdf.set_auto_page_break(auto=False)
-    
-    if os.path.exists(FONT_PATH):
-        pdf.add_font('THSarabun', '', FONT_PATH, uni=True)
-        pdf.add_font('THSarabun', 'B', FONT_PATH, uni=True)
-        use_f = 'THSarabun'
-    else:
-        use_f = 'Arial'
-
-    # ✅ FIX 2: กัน column "หน่วย" หาย
-    if 'หน่วย' not in items_df.columns:
-        items_df['หน่วย'] = ""
-
-    valid_items = items_df[items_df['รายการ'].astype(str).str.strip() != ""].copy()
-
-    # ================= HEADER FUNCTION =================
-    def draw_page_header():
-        if os.path.exists("logo11.jpg"):
-            pdf.image("logo11.jpg", x=15, y=10, w=25)
-                
-        pdf.set_xy(45, 10)
-        pdf.set_font(use_f, 'B', 18)
-        pdf.cell(0, 8, f"{d.get('my_comp', '')}", 0, 1, 'L')
-        
-        pdf.set_x(45)
-        pdf.set_font(use_f, '', 14)
-        pdf.multi_cell(100, 6, f"{d.get('my_addr', '')}\nโทร: {d.get('my_tel', '')}\nเลขผู้เสียภาษี: {d.get('my_tax', '')}", 0, 'L')
-
-        pdf.set_xy(140, 10)
-        pdf.set_font(use_f, 'B', 14)
-        pdf.cell(55, 20, "", 1, 0)
-        pdf.set_xy(142, 13)
-        pdf.cell(50, 6, f"เลขที่: {d.get('doc_no', '')}", 0, 1, 'L')
-        pdf.set_x(142)
-        pdf.cell(50, 6, f"วันที่: {d.get('doc_date', '')}", 0, 1, 'L')
-
-        pdf.set_y(45)
-        pdf.set_font(use_f, 'B', 26)
-        pdf.cell(0, 10, doc_title, 0, 1, 'C')
-
-        pdf.set_y(60)
-        start_y = pdf.get_y()
-        
-        pdf.set_font(use_f, 'B', 14)
-        pdf.cell(15, 7, "ลูกค้า: ", 0, 0)
-        pdf.set_font(use_f, '', 14)
-        pdf.cell(0, 7, f"{d.get('c_name', '')}", 0, 1)
-        
-        pdf.set_x(15)
-        pdf.set_font(use_f, 'B', 14)
-        pdf.cell(20, 7, "ผู้ติดต่อ: ", 0, 0)
-        pdf.set_font(use_f, '', 14)
-        pdf.cell(0, 7, f"{d.get('contact', '')}", 0, 1)
-        
-        pdf.set_x(15)
-        pdf.multi_cell(110, 6, f"ที่อยู่: {d.get('c_addr', '')}\nโทร: {d.get('c_tel', '')}", 0, 'L')
-        
-        pdf.set_xy(135, start_y)
-        pdf.multi_cell(65, 7, 
-            f"กำหนดส่ง: {d.get('due_date', '')}\n"
-            f"ยืนราคา: {d.get('valid_days', '')} วัน\n"
-            f"ครบกำหนด: {d.get('exp_date', '')}", 
-            0, 'L')
-
-    # ================= TABLE HEADER =================
-    cols_w = [12, 73, 15, 15, 25, 15, 25] 
-    headers = ["ลำดับ", "รายการสินค้า", "จำนวน", "หน่วย", "ราคา/หน่วย", "ส่วนลด", "จำนวนเงิน"]
-
-    def draw_table_header():
-        pdf.set_fill_color(240, 240, 240)
-        pdf.set_font(use_f, 'B', 13)
-        for i, h in enumerate(headers):
-            pdf.cell(cols_w[i], 9, h, 1, 0, 'C', True)
-        pdf.ln()
-        pdf.set_font(use_f, '', 13)
-
-    # ================= START =================
+    use_f = register_fonts(pdf)
     pdf.add_page()
-    draw_page_header()
-    pdf.set_y(90)
-    draw_table_header()
-
-    index = 0
-
-    for _, row in valid_items.iterrows():
-
-        q = to_f(row.get('จำนวน'))
-        p = to_f(row.get('ราคา'))
-        dis = to_f(row.get('ส่วนลด'))
-        total = round((q * p) - dis, 2)
-
-        vals = [
-            str(index + 1),
-            str(row.get('รายการ')),
-            f"{q:,.2f}",
-            safe_str(row.get('หน่วย')),  # ✅ FIX
-            f"{p:,.2f}",
-            f"{dis:,.2f}" if dis > 0 else "-",
-            f"{total:,.2f}"
-        ]
-
-        max_lines = 1
-        for j, txt in enumerate(vals):
-            w = pdf.get_string_width(txt)
-            if w > 0:
-                lines = math.ceil(w / (cols_w[j] - 2))
-                if lines > max_lines:
-                    max_lines = lines
-        
-        h = max(8, 7 * max_lines)
-
-        x = pdf.get_x()
-        y = pdf.get_y()
-
-        # ⭐ ขึ้นหน้าใหม่ + วาดหัวตารางใหม่
-        if y + h > 250:
-            pdf.add_page()
-            draw_page_header()
-            pdf.set_y(90)
-            draw_table_header()
-            x = pdf.get_x()
-            y = pdf.get_y()
-
-        for j, txt in enumerate(vals):
-            align = 'C' if j != 1 else 'L'
-            pdf.rect(x, y, cols_w[j], h)
-            pdf.set_xy(x, y)
-            pdf.multi_cell(cols_w[j], 7, txt, 0, align)
-            x += cols_w[j]
-
-        pdf.set_xy(15, y + h)
-        index += 1
-
-    # ================= SUMMARY =================
-    if pdf.get_y() + 60 > 250:
-        pdf.add_page()
-
-    pdf.ln(2)
-    current_y = pdf.get_y()
-
-    pdf.set_font(use_f, 'B', 14)
-    pdf.cell(0, 7, "หมายเหตุ / Remarks:", 0, 1)
-    pdf.set_font(use_f, '', 13)
-    pdf.multi_cell(90, 5, remark_text, 0, 'L')
-
-    sum_x_label = 130 
-    sum_x_val = 170   
-    sum_y = current_y
-
-    def print_sum_row(label, value):
-        nonlocal sum_y
-        pdf.set_xy(sum_x_label, sum_y)
-        pdf.cell(40, 6, label, 0, 0, 'R')
-        pdf.set_xy(sum_x_val, sum_y)
-        pdf.cell(25, 6, f"{value:,.2f}", 0, 1, 'R')
-        sum_y += 6
-
-    print_sum_row("รวมเงินสินค้า:", summary['gross'])
-    print_sum_row("หักส่วนลด:", summary['discount'])
-    print_sum_row("ยอดหลังหักส่วนลด:", summary['subtotal'])
-
-    if show_vat_line:
-        print_sum_row("ภาษีมูลค่าเพิ่ม 7%:", summary['vat'])
-
-    grand_total_val = summary['grand_total']
-    baht_text_str = bahttext(grand_total_val)
-
-    pdf.set_xy(15, sum_y)
-    pdf.cell(115, 6, f"({baht_text_str})", 0, 0, 'C')
-
-    pdf.set_xy(130, sum_y)
-    pdf.cell(40, 6, "ยอดรวมสุทธิ:", 0, 0, 'R')
-
-    pdf.set_xy(170, sum_y)
-    pdf.cell(25, 6, f"{grand_total_val:,.2f}", 0, 1, 'R')
-
-    # ================= SIGNATURE =================
-    pdf.set_y(-42)
     pdf.set_font(use_f, '', 13)
+    return pdf
 
-    sig_labels = ["ผู้จัดทำ", "ผู้อนุมัติ"]
-    names = [sigs.get('s1', ''), sigs.get('s2', '')]
-    images = [sigs.get('img1'), None]
-
-    x_positions = [40, 130]
-    y_sig = pdf.get_y()
+def layout_items(items_df):
+    # วางผังอย่างเดียวไม่สร้าง PDF ใช้แสดงจำนวนหน้า/จุดขึ้นหน้าใหม่บนหน้าจอ
+    return plan_layout(_measure_pdf(), item_cells(valid_item_rows(items_df.copy())))
 
-    for i in range(2):
-        if i == 0 and images[i]:
+# ==========================================
+# แคชไฟล์ PDF ที่ render แล้ว (key = hash ของข้อมูลทั้งหมดที่ใช้สร้าง PDF)
+# ==========================================
+RENDER_CACHE_VERSION = 1     # เปลี่ยนเมื่อรูปแบบ PDF เปลี่ยนโดยที่ไฟล์โค้ด/ฟอนต์ไม่ได้เปลี่ยน
+RENDER_CACHE_MB = int(os.environ.get("PDF_CACHE_MB", 64))
+RENDER_CACHE_DIR = os.environ.get("PDF_CACHE_DIR", "")          # ว่าง = ไม่เก็บลงดิสก์
+RENDER_CACHE_DISK_MB = int(os.environ.get("PDF_CACHE_DISK_MB", 512))
+
+_fingerprint = None
+
+# โหมด deterministic: ข้อมูลเท่ากัน = ไฟล์เท่ากันทุก byte (fpdf ใส่ CreationDate เป็นเวลาปัจจุบัน นอกนั้นคงที่อยู่แล้ว)
+# ใช้เทียบไฟล์/หา PDF ซ้ำด้วย hash ได้
+DETERMINISTIC = os.environ.get("PDF_DETERMINISTIC", "0") == "1"
+DETERMINISTIC_CREATION_DATE = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+def _renderer_fingerprint():
+    # ไฟล์โค้ด/ฟอนต์/โลโก้เปลี่ยน = key เปลี่ยน ไฟล์ที่ spill ลงดิสก์ไว้จากเวอร์ชันเก่าจะไม่ถูกหยิบมาใช้
+    global _fingerprint
+    if _fingerprint is None:
+        parts = [str(RENDER_CACHE_VERSION)]
+        for path in [__file__, sys.modules['pricing'].__file__, sys.modules['thai_text'].__file__, FONT_PATH, LOGO_PATH]:
             try:
-                if hasattr(images[i], 'read'):
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
-                        tmp.write(images[i].getvalue())
-                        tmp_path = tmp.name
-                    pdf.image(tmp_path, x=x_positions[i] + 5, y=y_sig - 12, w=30, h=12)
-                    os.remove(tmp_path)
-            except:
-                pass
-
-        pdf.set_xy(x_positions[i], y_sig)
-        pdf.cell(40, 6, "........................................", 0, 1, 'C')
-        pdf.set_xy(x_positions[i], y_sig + 6)
-        pdf.cell(40, 6, sig_labels[i], 0, 1, 'C')
-        pdf.set_xy(x_positions[i], y_sig + 12)
-        disp = f"({names[i]})" if names[i] else "(........................................)"
-        pdf.cell(40, 6, disp, 0, 1, 'C')
-        pdf.set_xy(x_positions[i], y_sig + 18)
-        pdf.cell(40, 6, "วันที่ ...../...../..........", 0, 1, 'C')
-
-    return bytes(pdf.output())
-
-
-def convert_pdf_to_image(pdf_bytes, format_type):
-    if not HAS_IMG_LIB:
-        return None, "กรุณาติดตั้งไลบรารีเพิ่มเติม: pip install PyMuPDF Pillow"
-    try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        images = []
-        for page in doc:
-            pix = page.get_pixmap(dpi=150)
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            images.append(img)
-        
-        if not images:
-            return None, "ไม่สามารถอ่านหน้า PDF ได้"
-            
-        widths, heights = zip(*(i.size for i in images))
-        new_im = Image.new('RGB', (max(widths), sum(heights)), (255, 255, 255))
-        y_offset = 0
-        for im in images:
-            new_im.paste(im, (0, y_offset))
-            y_offset += im.size[1]
-            
-        img_byte_arr = io.BytesIO()
-        pil_format = "JPEG" if format_type.upper() == "JPG" else "PNG"
-        new_im.save(img_byte_arr, format=pil_format)
-        return img_byte_arr.getvalue(), None
-    except Exception as e:
-        return None, str(e)
-import io
-import tempfile
-import math
-from fpdf import FPDF
-from bahttext import bahttext 
-from database import to_int
-
-try:
-    import fitz 
-    from PIL import Image 
-    HAS_IMG_LIB = True
-except ImportError:
-    HAS_IMG_LIB = False
-
-FONT_PATH = "THSarabunNew.ttf" 
-
-def to_f(val):
-    try:
-        if isinstance(val, str): val = val.replace(',', '')
-        return float(val) if val is not None else 0.0
-    except:
-        return 0.0
-
-# ✅ FIX 1: กันค่า NaN / None
-def safe_str(val):
-    if val is None:
-        return ""
-    if str(val).lower() == "nan":
-        return ""
-    return str(val)
+                info = os.stat(path)
+                parts.append(f"{os.path.basename(path)}:{info.st_size}:{info.st_mtime_ns}")
+            except OSError:
+                parts.append(os.path.basename(path))
+        _fingerprint = "|".join(parts)
+    return _fingerprint
+
+def _sig_value(val):
+    if hasattr(val, 'getvalue'):
+        return hashlib.blake2b(val.getvalue(), digest_size=16).hexdigest()
+    return val
+
+def render_key(d, items_df, summary, sigs, remark_text, show_vat_line, doc_title, deterministic=False):
+    h = hashlib.blake2b(digest_size=20)
+    h.update(_renderer_fingerprint().encode('utf-8'))
+    head = [d, summary, {k: _sig_value(v) for k, v in (sigs or {}).items()}, remark_text, bool(show_vat_line), doc_title, bool(deterministic)]
+    h.update(json.dumps(head, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'))
+    h.update(items_df.to_json(orient='split', force_ascii=False, default_handler=str).encode('utf-8'))
+    return h.hexdigest()
+
+render_cache = BlobCache(RENDER_CACHE_MB * 1024 * 1024, RENDER_CACHE_DIR, RENDER_CACHE_DISK_MB * 1024 * 1024, suffix=".pdf")
 
 # ==========================================
 # PDF ENGINE (dynamic + header repeat + กันชน)
 # ==========================================
-def create_pdf(d, items_df, summary, sigs, remark_text, show_vat_line, doc_title="ใบเสนอราคา (QUOTATION)"):
+def create_pdf(d, items_df, summary, sigs, remark_text, show_vat_line, doc_title="ใบเสนอราคา (QUOTATION)", use_cache=True, deterministic=None):
+    # ข้อมูลเหมือนเดิมทุกอย่าง (หัวเอกสาร รายการ ยอด ลายเซ็น หมายเหตุ) ได้ไฟล์เดิมจากแคชทันที
+    # deterministic=None ใช้ค่าจาก PDF_DETERMINISTIC
+    if deterministic is None:
+        deterministic = DETERMINISTIC
+    if not use_cache:
+        return _render_pdf(d, items_df, summary, sigs, remark_text, show_vat_line, doc_title, deterministic)
+    key = render_key(d, items_df, summary, sigs, remark_text, show_vat_line, doc_title, deterministic)
+    pdf_bytes = render_cache.get(key)
+    if pdf_bytes is None:
+        pdf_bytes = _render_pdf(d, items_df, summary, sigs, remark_text, show_vat_line, doc_title, deterministic)
+        render_cache.put(key, pdf_bytes)
+    return pdf_bytes
+
+def _render_pdf(d, items_df, summary, sigs, remark_text, show_vat_line, doc_title, deterministic=False):
     pdf = FPDF(unit='mm', format='A4')
+    if deterministic:
+        pdf.set_creation_date(DETERMINISTIC_CREATION_DATE)
     pdf.set_margins(15, 15, 15)
     pdf.set_auto_page_break(auto=False)
     
-    if os.path.exists(FONT_PATH):
-        pdf.add_font('THSarabun', '', FONT_PATH, uni=True)
-        pdf.add_font('THSarabun', 'B', FONT_PATH, uni=True)
-        use_f = 'THSarabun'
-    else:
-        use_f = 'Arial'
+    use_f = register_fonts(pdf)
+    preload_image(pdf, LOGO_PATH)
 
     # ✅ FIX 2: กัน column "หน่วย" หาย
-    if 'หน่วย' not in items_df.columns:
-        items_df['หน่วย'] = ""
-
-    valid_items = items_df[items_df['รายการ'].astype(str).str.strip() != ""].copy()
+    valid_items = valid_item_rows(items_df)
 
     # ================= HEADER FUNCTION =================
     def draw_page_header():
-        if os.path.exists("logo11.jpg"):
-            pdf.image("logo11.jpg", x=15, y=10, w=25)
+        if os.path.exists(LOGO_PATH):
+            pdf.image(LOGO_PATH, x=15, y=10, w=25)
                 
         pdf.set_xy(45, 10)
         pdf.set_font(use_f, 'B', 18)
@@ -377,76 +352,75 @@ def create_pdf(d, items_df, summary, sigs, remark_text, show_vat_line, doc_title
             0, 'L')
 
     # ================= TABLE HEADER =================
-    cols_w = [12, 73, 15, 15, 25, 15, 25] 
+    cols_w = COLS_W
     headers = ["ลำดับ", "รายการสินค้า", "จำนวน", "หน่วย", "ราคา/หน่วย", "ส่วนลด", "จำนวนเงิน"]
 
     def draw_table_header():
         pdf.set_fill_color(240, 240, 240)
         pdf.set_font(use_f, 'B', 13)
         for i, h in enumerate(headers):
-            pdf.cell(cols_w[i], 9, h, 1, 0, 'C', True)
+            pdf.cell(cols_w[i], TABLE_HEADER_H, h, 1, 0, 'C', True)
         pdf.ln()
         pdf.set_font(use_f, '', 13)
 
+    # ================= HEADER TEMPLATE =================
+    # หัวกระดาษ + หัวตารางเหมือนกันทุกหน้า: วาดจริงแค่หน้าแรก เก็บคำสั่งวาด (content stream) ไว้
+    # แล้วหน้าถัดไปประทับคำสั่งชุดเดิมลงไปเลย ไม่ต้องจัดวางข้อความใหม่ทุกหน้า
+    # ใช้ส่วนภายในของ fpdf2 (_out, _resource_catalog) ถ้าเวอร์ชันที่ติดตั้งไม่มี ให้วาดใหม่ทุกหน้าตามปกติ
+    header_tpl = {}
+    can_replay = hasattr(pdf, '_out') and hasattr(getattr(pdf, '_resource_catalog', None), 'index_stream_resources')
+
+    def draw_header_block():
+        # สถานะสี/ฟอนต์ตอนเริ่มต้องเหมือนกันทุกหน้า คำสั่งที่เก็บไว้ถึงจะวาดออกมาเหมือนเดิม
+        pdf.set_font(use_f, '', 13)
+        pdf.set_fill_color(0)
+        contents = pdf.pages[pdf.page].contents
+        if header_tpl and isinstance(contents, bytearray):
+            try:
+                pdf._out(header_tpl['stream'])
+                pdf._resource_catalog.index_stream_resources(header_tpl['stream'].decode('latin-1'), pdf.page)
+                pdf.fill_color = header_tpl['fill_color']
+                pdf.set_xy(*header_tpl['end_xy'])
+                return
+            except Exception:
+                header_tpl.clear()
+
+        start = len(contents)
+        draw_page_header()
+        pdf.set_y(TABLE_TOP)
+        draw_table_header()
+        if can_replay and isinstance(contents, bytearray):
+            header_tpl['stream'] = bytes(contents[start:]).rstrip(b"\n")
+            header_tpl['fill_color'] = pdf.fill_color
+            header_tpl['end_xy'] = (pdf.get_x(), pdf.get_y())
+
     # ================= START =================
     pdf.add_page()
-    draw_page_header()
-    pdf.set_y(90)
-    draw_table_header()
-
-    index = 0
-
-    for _, row in valid_items.iterrows():
-
-        q = to_f(row.get('จำนวน'))
-        p = to_f(row.get('ราคา'))
-        dis = to_f(row.get('ส่วนลด'))
-        total = round((q * p) - dis, 2)
-
-        vals = [
-            str(index + 1),
-            str(row.get('รายการ')),
-            f"{q:,.2f}",
-            safe_str(row.get('หน่วย')),  # ✅ FIX
-            f"{p:,.2f}",
-            f"{dis:,.2f}" if dis > 0 else "-",
-            f"{total:,.2f}"
-        ]
-
-        max_lines = 1
-        for j, txt in enumerate(vals):
-            w = pdf.get_string_width(txt)
-            if w > 0:
-                lines = math.ceil(w / (cols_w[j] - 2))
-                if lines > max_lines:
-                    max_lines = lines
-        
-        h = max(8, 7 * max_lines)
+    draw_header_block()
 
-        x = pdf.get_x()
-        y = pdf.get_y()
+    # รอบแรก: ตัดบรรทัดและแบ่งหน้าทั้งตาราง / รอบสอง: วาดตามผังโดยไม่ต้องวัดซ้ำ
+    plan = plan_layout(pdf, item_cells(valid_items))
 
-        # ⭐ ขึ้นหน้าใหม่ + วาดหัวตารางใหม่
-        if y + h > 250:
+    for row in plan['rows']:
+        if row['page'] != pdf.page:
+            # ⭐ ขึ้นหน้าใหม่ + วาดหัวตารางใหม่
             pdf.add_page()
-            draw_page_header()
-            pdf.set_y(90)
-            draw_table_header()
-            x = pdf.get_x()
-            y = pdf.get_y()
-
-        for j, txt in enumerate(vals):
-            align = 'C' if j != 1 else 'L'
+            draw_header_block()
+
+        x = 15
+        y = row['y']
+        h = row['h']
+        for j, cell_lines in enumerate(row['cells']):
             pdf.rect(x, y, cols_w[j], h)
-            pdf.set_xy(x, y)
-            pdf.multi_cell(cols_w[j], 7, txt, 0, align)
+            for k, line in enumerate(cell_lines):
+                pdf.set_xy(x, y + k * LINE_H)
+                pdf.cell(cols_w[j], LINE_H, line, 0, 0, COL_ALIGNS[j])
             x += cols_w[j]
 
         pdf.set_xy(15, y + h)
-        index += 1
 
     # ================= SUMMARY =================
-    if pdf.get_y() + 60 > 250:
+    if plan['summary_page'] != pdf.page:
         pdf.add_page()
 
     pdf.ln(2)
@@ -524,30 +498,294 @@ def create_pdf(d, items_df, summary, sigs, remark_text, show_vat_line, doc_title
     return bytes(pdf.output())
 
 
-def convert_pdf_to_image(pdf_bytes, format_type):
+# ==========================================
+# สร้าง PDF จาก data_json ที่บันทึกไว้ (ใช้ร่วมกันทั้งแปลงเอกสาร, batch และ CLI)
+# ==========================================
+DOC_TITLES = {
+    "QT": "ใบเสนอราคา (QUOTATION)",
+    "IV": "ใบแจ้งหนี้ (INVOICE)",
+    "RE": "ใบเสร็จรับเงิน (RECEIPT)",
+}
+
+def payload_doc_date(data):
+    # doc_date_str เก็บเป็น YYYY-MM-DD แต่ใน PDF แสดงเป็น dd/mm/YYYY
+    raw = str(data.get('doc_date_str', ''))
+    try:
+        return datetime.strptime(raw, "%Y-%m-%d").strftime("%d/%m/%Y")
+    except:
+        return raw
+
+def make_job(data, doc_no, doc_date, doc_type, recorded_total=None):
+    # งาน 1 ใบจาก data_json (dict/list ล้วน ส่งข้ามโปรเซสได้)
+    # payload เก่าไม่ได้เก็บ vat: ถ้าส่งยอดที่บันทึกไว้ (history_quotes.total) มา ดูว่าตรงกับยอดแบบมี VAT หรือไม่
+    data = load_payload(data)
+    if "vat" in data:
+        has_vat = to_f(data["vat"]) > 0
+    elif recorded_total is not None:
+        _, with_vat = price_items(items_frame(data.get("items", [])), True)
+        has_vat = abs(with_vat["grand_total"] - to_f(recorded_total)) < 0.005
+    else:
+        has_vat = False
+    # หมายเหตุและชื่อผู้ลงนามเป็นของใบเสนอราคา ใบแจ้งหนี้/ใบเสร็จที่แปลงมาเว้นว่างไว้เหมือนเดิม
+    is_qt = doc_type == "QT"
+    return {
+        "pdf_data": {
+            "my_comp": data.get("my_comp", ""), "my_addr": data.get("my_addr", ""),
+            "my_tel": data.get("my_tel", ""), "my_tax": data.get("my_tax", ""),
+            "doc_no": doc_no, "doc_date": doc_date, "exp_date": data.get("exp_date", ""),
+            "valid_days": data.get("valid_days", ""), "due_date": data.get("due_date", ""),
+            "c_name": data.get("c_name", ""), "contact": data.get("contact", ""),
+            "c_addr": data.get("c_addr", ""), "c_tel": data.get("c_tel", "")
+        },
+        "items": data.get("items", []),
+        "has_vat": has_vat,
+        "remark": data.get("remark", "") if is_qt else "",
+        "signers": [data.get("s1", ""), data.get("s2", "")] if is_qt else ["", ""],
+        "doc_title": DOC_TITLES.get(doc_type, DOC_TITLES["QT"]),
+        "filename": f"{doc_no}.pdf",
+    }
+
+def job_totals(job):
+    _, totals = price_items(items_frame(job["items"]), job["has_vat"])
+    return totals
+
+def render_job(job, deterministic=None, use_cache=True):
+    items_df = items_frame(job["items"])
+    _, totals = price_items(items_df, job["has_vat"])
+    s1, s2 = job.get("signers", ["", ""])
+    sigs = {"s1": s1, "s2": s2, "s3": "", "img1": None, "img2": None, "img3": None}
+    return create_pdf(job["pdf_data"], items_df, totals, sigs, job.get("remark", ""), job["has_vat"], doc_title=job["doc_title"], use_cache=use_cache, deterministic=deterministic)
+
+def main(argv=None):
+    # python -m pdf_generator payload.json out.pdf [--doc-no QT-...] [--type QT|IV|RE] [--date dd/mm/YYYY] [--deterministic]
+    # payload เป็น data_json ตรงๆ หรือทั้งแถวของ history_quotes ({"doc_no": ..., "data_json": ...}) ก็ได้
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m pdf_generator", description="สร้าง PDF จาก data_json ที่บันทึกไว้")
+    parser.add_argument("payload")
+    parser.add_argument("output")
+    parser.add_argument("--doc-no", default=None)
+    parser.add_argument("--type", choices=sorted(DOC_TITLES), default=None)
+    parser.add_argument("--date", default=None)
+    parser.add_argument("--deterministic", action="store_true", help="ไฟล์เหมือนกันทุก byte เมื่อข้อมูลเท่ากัน")
+    args = parser.parse_args(argv)
+
+    with open(args.payload, encoding="utf-8") as f:
+        payload = json.load(f)
+    data = payload
+    if "data_json" in payload:
+        data = load_payload(payload["data_json"])
+
+    doc_no = args.doc_no or payload.get("doc_no") or os.path.splitext(os.path.basename(args.payload))[0]
+    doc_type = args.type or (doc_no[:2].upper() if doc_no[:2].upper() in DOC_TITLES else "QT")
+    job = make_job(data, doc_no, args.date or payload_doc_date(data), doc_type, recorded_total=payload.get("total"))
+    pdf_bytes = render_job(job, deterministic=args.deterministic or None)
+
+    with open(args.output, "wb") as f:
+        f.write(pdf_bytes)
+    print(f"{args.output}: {len(pdf_bytes):,} bytes")
+    return 0
+
+
+# ==========================================
+# แปลง PDF เป็นรูป (render ทีละหน้า เขียนลงผลลัพธ์ทันที ไม่เก็บรูปทุกหน้าไว้พร้อมกัน)
+# ==========================================
+IMAGE_DPI = 150
+IMAGE_QUALITY = 90
+IMAGE_LAYOUTS = ("stitched", "pages", "tiff")   # รูปเดียวต่อกันยาว / zip แยกหน้า / TIFF หลายหน้า
+IMAGE_CACHE_MB = int(os.environ.get("IMAGE_CACHE_MB", 128))
+
+# รูปที่แปลงแล้ว key = (hash ของ PDF, รูปแบบ, dpi, quality, layout) ใช้ LRU แบบเดียวกับแคช PDF แต่ไม่ spill ลงดิสก์
+image_cache = BlobCache(IMAGE_CACHE_MB * 1024 * 1024)
+
+def image_export_info(format_type, layout="stitched"):
+    # (นามสกุลไฟล์, mime) ของผลลัพธ์ convert_pdf_to_image
+    if layout == "tiff" or format_type.upper() in ("TIF", "TIFF"):
+        return "tif", "image/tiff"
+    if layout == "pages":
+        return "zip", "application/zip"
+    if _pil_format(format_type) == "JPEG":
+        return "jpg", "image/jpeg"
+    return "png", "image/png"
+
+def _pil_format(format_type):
+    return "JPEG" if format_type.upper() in ("JPG", "JPEG") else "PNG"
+
+def _available_cpus():
+    # os.cpu_count() ในคอนเทนเนอร์ (Render ฯลฯ) คือ CPU ของเครื่อง host ไม่ใช่โควต้าที่ได้จริง
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# process pool กลางตัวเดียว ใช้ทั้งสร้าง PDF ทั้งชุด (batch_render) และแปลงหน้าเป็นรูป
+# worker แต่ละตัวโหลดฟอนต์/PyMuPDF ของตัวเอง จึงจำกัดจำนวนไว้ไม่ให้ instance เล็กๆ หน่วยความจำหมด
+MAX_POOL_WORKERS = 2
+POOL_WORKERS = int(os.environ.get("PDF_POOL_WORKERS", "0")) or min(MAX_POOL_WORKERS, _available_cpus())
+RASTER_MIN_PAGES = 4    # เอกสารสั้นกว่านี้ render ในโปรเซสเดียวเร็วกว่าส่งงานข้ามโปรเซส
+RASTER_CHUNK_PAGES = 2  # จำนวนหน้าต่องานของ worker
+
+_pool_lock = threading.Lock()
+_pool = None
+
+def pool_context():
+    # process pool ห้ามใช้ fork (ค่าเริ่มต้นบน Linux): Streamlit มีหลาย thread ลูกที่ fork ออกมาอาจได้ lock ที่ถูกถือค้างไว้แล้วค้างไปเลย
+    # forkserver/spawn เริ่ม worker จากโปรเซสใหม่ (Windows มีแค่ spawn)
+    import multiprocessing
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+def get_worker_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            # โหลดฟอนต์/โลโก้ครั้งเดียวต่อ worker
+            _pool = ProcessPoolExecutor(max_workers=POOL_WORKERS, initializer=warm_up, mp_context=pool_context())
+        return _pool
+
+def reset_worker_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def _rasterize_page(page, dpi, encode, quality):
+    # encode = None: คืน (ขนาด, pixel RGB ดิบ) / "JPG"/"PNG": คืนไฟล์รูปของหน้านั้น
+    from PIL import Image
+    pix = page.get_pixmap(dpi=dpi, alpha=False)
+    if encode is None:
+        return (pix.width, pix.height), pix.samples
+    buf = io.BytesIO()
+    _save_image(Image.frombytes("RGB", [pix.width, pix.height], pix.samples), buf, encode, quality)
+    return buf.getvalue()
+
+def _rasterize_range(pdf_bytes, dpi, start, stop, encode, quality):
+    # งานของ worker: เปิด PDF เอง แล้ว render หน้า start..stop-1
+    import fitz
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        return [_rasterize_page(doc[i], dpi, encode, quality) for i in range(start, stop)]
+    finally:
+        doc.close()
+
+def _as_page(item, encode):
+    if encode is not None:
+        return item
+    from PIL import Image
+    size, samples = item
+    return Image.frombytes("RGB", size, samples)
+
+def _page_images(pdf_bytes, doc, dpi, encode=None, quality=IMAGE_QUALITY):
+    # ได้ผลทีละหน้าตามลำดับ ถ้าหน้าเยอะและมีหลายคอร์ แบ่งช่วงหน้าให้ worker หลายตัวช่วยกัน
+    # ส่งงานค้างไว้ไม่เกิน (worker + 1) ช่วง หน่วยความจำจึงขึ้นกับจำนวน worker ไม่ใช่จำนวนหน้า
+    n = doc.page_count
+    next_page = 0
+    if POOL_WORKERS > 1 and n >= RASTER_MIN_PAGES:
+        from collections import deque
+        from concurrent.futures.process import BrokenProcessPool
+        chunk = RASTER_CHUNK_PAGES
+        ranges = iter([(i, min(i + chunk, n)) for i in range(0, n, chunk)])
+        pending = deque()
+        try:
+            pool = get_worker_pool()
+            for start, stop in ranges:
+                pending.append((start, pool.submit(_rasterize_range, pdf_bytes, dpi, start, stop, encode, quality)))
+                if len(pending) > POOL_WORKERS:
+                    break
+            while pending:
+                start, future = pending[0]
+                results = future.result()
+                pending.popleft()
+                nxt = next(ranges, None)
+                if nxt is not None:
+                    pending.append((nxt[0], pool.submit(_rasterize_range, pdf_bytes, dpi, nxt[0], nxt[1], encode, quality)))
+                for item in results:
+                    yield _as_page(item, encode)
+                    next_page += 1
+        except BrokenProcessPool:
+            # worker ตาย: ทำหน้าที่เหลือต่อในโปรเซสนี้
+            reset_worker_pool()
+    for i in range(next_page, n):
+        yield _as_page(_rasterize_page(doc[i], dpi, encode, quality), encode)
+
+def _save_image(img, out, format_type, quality):
+    if _pil_format(format_type) == "JPEG":
+        img.save(out, format="JPEG", quality=quality)
+    else:
+        img.save(out, format="PNG")
+
+def _write_stitched(pdf_bytes, doc, out, format_type, dpi, quality):
+    # ขนาดรูปรวมคำนวณจากขนาดหน้า ไม่ต้อง render ก่อน จองรูปใหญ่ครั้งเดียวแล้ววางทีละหน้า
+    import fitz
+    from PIL import Image
+    zoom = fitz.Matrix(dpi / 72, dpi / 72)
+    sizes = [(page.rect * zoom).irect for page in doc]
+    canvas = Image.new('RGB', (max(r.width for r in sizes), sum(r.height for r in sizes)), (255, 255, 255))
+    y_offset = 0
+    for img in _page_images(pdf_bytes, doc, dpi):
+        canvas.paste(img, (0, y_offset))
+        y_offset += img.size[1]
+    _save_image(canvas, out, format_type, quality)
+
+def _write_pages_zip(pdf_bytes, doc, out, format_type, dpi, quality):
+    ext = "jpg" if _pil_format(format_type) == "JPEG" else "png"
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_STORED) as zf:
+        for i, page_bytes in enumerate(_page_images(pdf_bytes, doc, dpi, encode=format_type, quality=quality), 1):
+            zf.writestr(f"page_{i:03d}.{ext}", page_bytes)
+
+def _write_tiff(pdf_bytes, doc, out, dpi):
+    from PIL import TiffImagePlugin
+    with TiffImagePlugin.AppendingTiffWriter(out) as tf:
+        for img in _page_images(pdf_bytes, doc, dpi):
+            img.save(tf, format="TIFF", compression="tiff_deflate", dpi=(dpi, dpi))
+            tf.newFrame()
+
+def convert_pdf_to_image(pdf_bytes, format_type, dpi=IMAGE_DPI, quality=IMAGE_QUALITY, layout="stitched", use_cache=True):
+    # format_type: JPG/PNG (หรือ TIFF = layout "tiff") คืนค่า (bytes, error)
     if not HAS_IMG_LIB:
         return None, "กรุณาติดตั้งไลบรารีเพิ่มเติม: pip install PyMuPDF Pillow"
+    if format_type.upper() in ("TIF", "TIFF"):
+        layout = "tiff"
+    if layout not in IMAGE_LAYOUTS:
+        return None, f"ไม่รู้จักรูปแบบ {layout}"
+    if not use_cache:
+        return _convert_pdf_to_image(pdf_bytes, format_type, dpi, quality, layout)
+
+    pdf_hash = hashlib.blake2b(pdf_bytes, digest_size=20).hexdigest()
+    key = f"{pdf_hash}:{_pil_format(format_type) if layout != 'tiff' else 'TIFF'}:{dpi}:{quality}:{layout}"
+    img_bytes = image_cache.get(key)
+    if img_bytes is not None:
+        return img_bytes, None
+    img_bytes, err = _convert_pdf_to_image(pdf_bytes, format_type, dpi, quality, layout)
+    if img_bytes is not None:
+        image_cache.put(key, img_bytes)
+    return img_bytes, err
+
+def _convert_pdf_to_image(pdf_bytes, format_type, dpi, quality, layout):
     try:
+        import fitz
         doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        images = []
-        for page in doc:
-            pix = page.get_pixmap(dpi=150)
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            images.append(img)
-        
-        if not images:
+        if doc.page_count == 0:
             return None, "ไม่สามารถอ่านหน้า PDF ได้"
-            
-        widths, heights = zip(*(i.size for i in images))
-        new_im = Image.new('RGB', (max(widths), sum(heights)), (255, 255, 255))
-        y_offset = 0
-        for im in images:
-            new_im.paste(im, (0, y_offset))
-            y_offset += im.size[1]
-            
-        img_byte_arr = io.BytesIO()
-        pil_format = "JPEG" if format_type.upper() == "JPG" else "PNG"
-        new_im.save(img_byte_arr, format=pil_format)
-        return img_byte_arr.getvalue(), None
+
+        out = io.BytesIO()
+        try:
+            if layout == "pages":
+                _write_pages_zip(pdf_bytes, doc, out, format_type, dpi, quality)
+            elif layout == "tiff":
+                _write_tiff(pdf_bytes, doc, out, dpi)
+            else:
+                _write_stitched(pdf_bytes, doc, out, format_type, dpi, quality)
+        finally:
+            doc.close()
+        return out.getvalue(), None
     except Exception as e:
         return None, str(e)
+
+
+if __name__ == "__main__":
+    # รันเป็น __main__ แล้ว Python แสดง DeprecationWarning ของ cell(ln=...) ทุกบรรทัด
+    import warnings
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    sys.exit(main())
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+# ==========================================
+# คำนวณราคา/ยอดรวมของรายการสินค้า (ใช้ร่วมกันทั้งใบเสนอราคา ใบแจ้งหนี้ ใบเสร็จ และ PDF)
+# ==========================================
+# คำนวณเป็นหน่วย "สตางค์" (จำนวนเต็ม) เพื่อไม่ให้ทศนิยมของ float สะสมคลาดเคลื่อนตอนรวมยอด
+VAT_RATE = 0.07
+
+def to_number(series):
+    # เหมือน to_float แต่ทำทั้งคอลัมน์: ตัด comma, ค่าที่แปลงไม่ได้/ว่าง = 0
+    if series.dtype == object or pd.api.types.is_string_dtype(series):
+        series = series.astype(str).str.replace(',', '', regex=False)
+    return pd.to_numeric(series, errors='coerce').fillna(0.0).astype(float)
+
+def _column(items_df, col):
+    if col in items_df.columns:
+        return to_number(items_df[col])
+    return pd.Series(0.0, index=items_df.index)
+
+def line_amounts(items_df):
+    # คืนค่า DataFrame (index เดียวกับ items_df): q, p, d, total และยอดเป็นสตางค์สำหรับรวมยอด
+    q = _column(items_df, 'จำนวน')
+    p = _column(items_df, 'ราคา')
+    d = _column(items_df, 'ส่วนลด')
+
+    gross_satang = np.rint(q.to_numpy() * p.to_numpy() * 100).astype(np.int64)
+    disc_satang = np.rint(d.to_numpy() * 100).astype(np.int64)
+    total_satang = np.rint((q.to_numpy() * p.to_numpy() - d.to_numpy()) * 100).astype(np.int64)
+
+    return pd.DataFrame({
+        'q': q,
+        'p': p,
+        'd': d,
+        'total': total_satang / 100,
+        'gross_satang': gross_satang,
+        'disc_satang': disc_satang,
+        'total_satang': total_satang,
+    }, index=items_df.index)
+
+def summarize(lines, has_vat, vat_rate=VAT_RATE):
+    # สรุปยอดจากผลของ line_amounts() ในรูปแบบเดียวกับที่ create_pdf() ใช้
+    gross = int(lines['gross_satang'].sum())
+    discount = int(lines['disc_satang'].sum())
+    subtotal = int(lines['total_satang'].sum())
+    vat = int(np.rint(subtotal * vat_rate)) if has_vat else 0
+    return {
+        "gross": gross / 100,
+        "discount": discount / 100,
+        "subtotal": subtotal / 100,
+        "vat": vat / 100,
+        "grand_total": (subtotal + vat) / 100,
+    }
+
+def price_items(items_df, has_vat, vat_rate=VAT_RATE):
+    lines = line_amounts(items_df)
+    return lines, summarize(lines, has_vat, vat_rate)
@@ -0,0 +1,62 @@
+-- ==========================================
+-- โครงสร้างเสริมฝั่ง Supabase (รันใน SQL Editor ครั้งเดียว)
+-- ==========================================
+
+-- ⭐ updated_at สำหรับ delta sync (database._sync_table ใช้เป็น watermark)
+create or replace function set_updated_at() returns trigger as $$
+begin
+    new.updated_at = now();
+    return new;
+end;
+$$ language plpgsql;
+
+alter table customers add column if not exists updated_at timestamptz not null default now();
+alter table products add column if not exists updated_at timestamptz not null default now();
+alter table history_quotes add column if not exists updated_at timestamptz not null default now();
+
+drop trigger if exists trg_customers_updated_at on customers;
+create trigger trg_customers_updated_at before insert or update on customers
+    for each row execute function set_updated_at();
+drop trigger if exists trg_products_updated_at on products;
+create trigger trg_products_updated_at before insert or update on products
+    for each row execute function set_updated_at();
+drop trigger if exists trg_history_quotes_updated_at on history_quotes;
+create trigger trg_history_quotes_updated_at before insert or update on history_quotes
+    for each row execute function set_updated_at();
+
+create index if not exists idx_customers_updated_at on customers (updated_at);
+create index if not exists idx_products_updated_at on products (updated_at);
+create index if not exists idx_history_quotes_updated_at on history_quotes (updated_at);
+
+-- ⭐ doc_no ต้องไม่ซ้ำ เพื่อให้ database.save_history_doc() upsert ด้วย on_conflict=doc_no ได้ใน request เดียว
+-- (ถ้ามีเลขซ้ำอยู่แล้ว ให้เก็บแถวล่าสุดไว้ก่อนสร้าง constraint)
+delete from history_quotes a using history_quotes b
+    where a.doc_no = b.doc_no and a.id < b.id;
+alter table history_quotes drop constraint if exists history_quotes_doc_no_key;
+alter table history_quotes add constraint history_quotes_doc_no_key unique (doc_no);
+
+-- ⭐ ตัวนับเลขเอกสารต่อ prefix ต่อวัน (เช่น QT-20240131) สำหรับ database.allocate_doc_no()
+-- insert ... on conflict do update ล็อกแถวของ prefix นั้น จึงไม่มีทางได้เลขซ้ำแม้กดพร้อมกันหลายคน
+create table if not exists doc_counters (
+    prefix text primary key,
+    last_no integer not null default 0
+);
+
+create or replace function next_doc_no(p_prefix text) returns text as $$
+declare
+    n integer;
+begin
+    insert into doc_counters (prefix, last_no)
+    values (
+        p_prefix,
+        coalesce((
+            select max(split_part(doc_no, '-', 3)::integer)
+            from history_quotes
+            where doc_no like p_prefix || '-%' and split_part(doc_no, '-', 3) ~ '^\d+$'
+        ), 0) + 1
+    )
+    on conflict (prefix) do update set last_no = doc_counters.last_no + 1
+    returning last_no into n;
+    return p_prefix || '-' || lpad(n::text, 3, '0');
+end;
+$$ language plpgsql;
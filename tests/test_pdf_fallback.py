@@ -0,0 +1,23 @@
+import pdf_generator
+from pdf_generator import make_job, render_job
+
+DATA = {
+    "v": 2, "vat": 7, "exp_date": "31/01/2026", "my_comp": "บริษัท ทดสอบ จำกัด", "c_name": "ลูกค้า",
+    "items": [["P001", "สายไฟ THW 1x2.5 sq.mm.", 100, "ม้วน", 1250, 0]] * 40,
+}
+
+def _render():
+    return render_job(make_job(DATA, "QT-20260101-001", "01/01/2026", "QT"), deterministic=True, use_cache=False)
+
+def test_font_falls_back_to_add_font_when_internals_change(monkeypatch):
+    # fpdf2 เวอร์ชันอื่นไม่มีส่วนภายในที่คัดลอก: ต้องใช้ add_font ปกติได้ไฟล์เหมือนเดิม
+    expected = _render()
+    monkeypatch.setattr(pdf_generator, "_FONT_DOC_STATE", pdf_generator._FONT_DOC_STATE + ("_not_in_fpdf",))
+    assert _render() == expected
+
+def test_header_drawn_normally_without_fpdf_internals(monkeypatch):
+    # ไม่มี _resource_catalog.index_stream_resources: วาดหัวกระดาษใหม่ทุกหน้าแทนการประทับคำสั่งเดิม
+    expected = _render()
+    from fpdf.output import ResourceCatalog
+    monkeypatch.delattr(ResourceCatalog, "index_stream_resources")
+    assert _render() == expected
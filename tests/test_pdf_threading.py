@@ -0,0 +1,43 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from pdf_generator import make_job, render_job
+
+ITEMS = [
+    ["P001", "สายไฟ THW 1x2.5 sq.mm.", 100, "ม้วน", 1250, 0],
+    ["P002", "ท่อร้อยสายไฟ EMT 1/2 นิ้ว", 40, "เส้น", 95.5, 5],
+    ["P003", "Breaker 2P 32A", 6, "ตัว", 480, 0],
+]
+
+def _jobs(count=24):
+    # แต่ละใบมีจำนวนรายการ/ชื่อลูกค้าต่างกัน ตัวอักษรที่ใช้ (subset ฟอนต์) และจำนวนหน้าจึงต่างกัน
+    jobs = []
+    for k in range(count):
+        data = {
+            "v": 2, "vat": 7 if k % 2 else 0, "exp_date": "31/01/2026",
+            "my_comp": "บริษัท ทดสอบ จำกัด", "my_addr": "ระยอง", "my_tel": "038-000000", "my_tax": "0000000000000",
+            "c_name": f"ลูกค้า {'กขคงจฉชซฌญ'[:k % 10]}{k}",
+            "items": (ITEMS * (k // len(ITEMS) + 1))[:k + 1] if k % 3 else ITEMS[:1],
+        }
+        jobs.append(make_job(data, f"QT-20260101-{k:03d}", "01/01/2026", "QT"))
+    return jobs
+
+@pytest.fixture
+def busy_switching():
+    # สลับ thread ถี่ๆ ให้ race ของ state ฟอนต์ที่ใช้ร่วมกันโผล่ออกมาแม้เครื่องมีคอร์เดียว
+    old = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(old)
+
+def test_threaded_render_matches_sequential(busy_switching):
+    # หลาย session ของ Streamlit สร้าง PDF พร้อมกัน (ไม่ผ่านแคช) ต้องได้ไฟล์เหมือนสร้างทีละใบทุก byte
+    jobs = _jobs()
+    expected = [render_job(job, deterministic=True, use_cache=False) for job in jobs]
+    order = list(range(len(jobs))) * 3
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda i: render_job(jobs[i], deterministic=True, use_cache=False), order))
+    mismatched = [jobs[i]["filename"] for i, pdf_bytes in zip(order, results) if pdf_bytes != expected[i]]
+    assert mismatched == []
@@ -0,0 +1,37 @@
+import pytest
+from fpdf import FPDF
+
+import thai_text
+from pdf_generator import COLS_W, FONT_PATH
+from thai_text import BREAK_WORD, break_ranks, clusters, wrap_text
+
+# ช่อง "รายการ" ของตารางสินค้า ฟอนต์ขนาดเดียวกับใน PDF
+ITEM_WIDTH_PT = (COLS_W[1] - 2 * 1.0) * 72 / 25.4
+FONT_SIZE = 14
+
+@pytest.fixture(params=[True, False], ids=["dict", "no-dict"])
+def font(request, monkeypatch):
+    if request.param and not thai_text.HAS_THAI_DICT:
+        pytest.skip("ไม่มี pythainlp")
+    monkeypatch.setattr(thai_text, "HAS_THAI_DICT", request.param)
+    thai_text._wrap_cached.cache_clear()
+    pdf = FPDF()
+    pdf.add_font("THSarabun", "", FONT_PATH)
+    pdf.set_font("THSarabun", "", FONT_SIZE)
+    yield pdf.current_font
+    thai_text._wrap_cached.cache_clear()
+
+def test_mixed_product_name_breaks_at_space(font):
+    # เว้นวรรคที่บรรทัดไม่เต็ม 60% ต้องชนะขอบกลุ่มตัวอักษรไทยที่อยู่ต้นบรรทัด (เดิมได้บรรทัดแรกแค่ "สาย")
+    lines = wrap_text(font, FONT_SIZE, ITEM_WIDTH_PT, "สายไฟ THW 1x2.5 sq.mm. Premium-GradeCableForIndoorWiring")
+    assert lines == ("สายไฟ THW 1x2.5 sq.mm.", "Premium-GradeCableForIndoorWiring")
+
+def test_latin_uses_space_before_cutting_word(font):
+    lines = wrap_text(font, FONT_SIZE, ITEM_WIDTH_PT, "A B " + "verylongword" * 4)
+    assert lines[0] == "A B"
+    assert "".join(lines[1:]) == "verylongword" * 4
+
+def test_no_dictionary_does_not_guess_word_edges(monkeypatch):
+    monkeypatch.setattr(thai_text, "HAS_THAI_DICT", False)
+    for word in ("สำหรับ", "ระยอง"):
+        assert BREAK_WORD not in break_ranks(clusters(word), word)[1:]
@@ -0,0 +1,143 @@
+import functools
+import threading
+
+try:
+    from pythainlp.tokenize import word_tokenize
+    HAS_THAI_DICT = True
+except ImportError:
+    HAS_THAI_DICT = False
+
+# ==========================================
+# ตัดบรรทัดข้อความไทยสำหรับช่องตารางใน PDF
+# ==========================================
+# ภาษาไทยไม่มีเว้นวรรคระหว่างคำ fpdf จึงตัดกลางตัวอักษรได้ทุกที่ (เช่น "ขน|าด" หรือแยกวรรณยุกต์ออกจากพยัญชนะ)
+# ที่นี่ตัดได้เฉพาะระหว่าง "กลุ่มตัวอักษร" (พยัญชนะ + สระบน/ล่าง/วรรณยุกต์, สระนำ + พยัญชนะ)
+# และเลือกจุดตัดที่ดีที่สุดก่อน: เว้นวรรค > ขอบคำ (ใช้พจนานุกรม pythainlp ถ้ามี) > ขอบกลุ่มตัวอักษร
+WRAP_CACHE_SIZE = 4096
+
+_ATTACH_PREV = set('ะัาำิีึืฺุูๅๆ็่้๊๋์ํ๎ฯ')   # ต้องอยู่ติดกับตัวก่อนหน้า
+_LEADING = set('เแโใไ')                        # สระนำ ต้องอยู่ติดกับตัวถัดไป
+
+# อันดับจุดตัด (น้อย = ดี)
+BREAK_SPACE = 0
+BREAK_WORD = 1
+BREAK_CLUSTER = 2
+BREAK_FORCED = 3
+MIN_LINE_FILL = 0.6   # จุดตัดที่ดีกว่าแต่อยู่ไกล ใช้ได้เมื่อบรรทัดยังเต็มอย่างน้อยเท่านี้
+
+_width_lock = threading.Lock()
+_width_tables = {}    # ชื่อฟอนต์ -> (list ความกว้างตาม codepoint ในช่วง BMP, ความกว้างตัวที่ไม่มีในฟอนต์)
+
+def is_thai(ch):
+    return '\u0e00' <= ch <= '\u0e7f'
+
+def clusters(text):
+    out = []
+    for ch in text:
+        if out and ch != ' ' and out[-1] != ' ' and (ch in _ATTACH_PREV or out[-1][-1] in _LEADING):
+            out[-1] += ch
+        else:
+            out.append(ch)
+    return out
+
+def _word_starts(text):
+    # ตำแหน่งตัวอักษรที่เป็นต้นคำตามพจนานุกรม
+    starts = set()
+    pos = 0
+    for word in word_tokenize(text, engine="newmm", keep_whitespace=True):
+        starts.add(pos)
+        pos += len(word)
+    return starts
+
+def break_ranks(units, text):
+    # ranks[i] = อันดับของจุดตัดก่อน units[i] (units[0] ไม่ใช้)
+    word_starts = _word_starts(text) if HAS_THAI_DICT and any(is_thai(c) for c in text) else None
+    ranks = [BREAK_FORCED] * len(units)
+    pos = len(units[0]) if units else 0
+    for i in range(1, len(units)):
+        prev, cur = units[i - 1], units[i]
+        if prev == ' ' or cur == ' ':
+            ranks[i] = BREAK_SPACE
+        elif is_thai(prev[-1]) or is_thai(cur[0]):
+            if word_starts is not None:
+                ranks[i] = BREAK_WORD if pos in word_starts else BREAK_CLUSTER
+            else:
+                # ไม่มีพจนานุกรม: รู้ขอบคำแน่ๆ แค่ตรงรอยต่อไทย/อังกฤษ (เดาจากสระ ะ ำ เ-ไ ตัดกลางคำจริง เช่น "สำ|หรับ", "ระ|ยอง")
+                ranks[i] = BREAK_WORD if is_thai(prev[-1]) != is_thai(cur[0]) else BREAK_CLUSTER
+        pos += len(cur)
+    return ranks
+
+def glyph_widths(font):
+    # ตารางความกว้างตัวอักษรของฟอนต์ (หน่วย 1/1000 em) สร้างครั้งเดียวต่อฟอนต์
+    with _width_lock:
+        if font.name not in _width_tables:
+            missing = font.desc.missing_width
+            cw = font.cw
+            table = [cw.get(c, missing) for c in range(0x10000)]
+            _width_tables[font.name] = (table, missing)
+        return _width_tables[font.name]
+
+def _units_width(units, table, missing):
+    widths = []
+    for u in units:
+        w = 0
+        for ch in u:
+            c = ord(ch)
+            w += table[c] if c < 0x10000 else missing
+        widths.append(w)
+    return widths
+
+def _break_paragraph(text, table, missing, limit):
+    units = clusters(text)
+    if not units:
+        return [""]
+    widths = _units_width(units, table, missing)
+    ranks = break_ranks(units, text)
+    prefix = [0]
+    for w in widths:
+        prefix.append(prefix[-1] + w)
+
+    lines = []
+    start = 0
+    i = 0
+    while i < len(units):
+        if i == start or prefix[i + 1] - prefix[start] <= limit:
+            i += 1
+            continue
+        # เกินความกว้าง: ใช้เว้นวรรค/ขอบคำที่ขวาสุดถ้าบรรทัดยังเต็มพอ
+        # ไม่งั้นตัดที่จุดตัดขวาสุดที่มี (เว้นวรรคที่อยู่ขวากว่าชนะขอบกลุ่มตัวอักษรที่อยู่ซ้าย) ตัดกลางคำอังกฤษเมื่อไม่มีทางอื่นเท่านั้น
+        cut = None
+        for rank in (BREAK_SPACE, BREAK_WORD):
+            b = next((b for b in range(i, start, -1) if ranks[b] == rank), None)
+            if b is not None and prefix[b] - prefix[start] >= limit * MIN_LINE_FILL:
+                cut = b
+                break
+        if cut is None:
+            cut = next((b for b in range(i, start, -1) if ranks[b] < BREAK_FORCED), i)
+        lines.append("".join(units[start:cut]).rstrip(' '))
+        while cut < len(units) and units[cut] == ' ':
+            cut += 1
+        start = cut
+        i = max(i, start)
+    if start < len(units):
+        lines.append("".join(units[start:]).rstrip(' '))
+    return lines
+
+@functools.lru_cache(maxsize=WRAP_CACHE_SIZE)
+def _wrap_cached(font_name, limit, text):
+    table, missing = _width_tables[font_name]
+    lines = []
+    for paragraph in text.split('\n'):
+        lines.extend(_break_paragraph(paragraph, table, missing, limit))
+    return tuple(lines)
+
+def wrap_text(font, size_pt, max_width_pt, text):
+    # คืนค่า tuple ของบรรทัด หรือ None ถ้าฟอนต์ไม่ใช่ TrueType (ให้ fpdf ตัดบรรทัดเอง)
+    if not hasattr(font, 'cmap'):
+        return None
+    glyph_widths(font)
+    limit = round(max_width_pt * 1000 / size_pt, 3)
+    return _wrap_cached(font.name, limit, text)
+
+def wrap_cache_info():
+    return _wrap_cached.cache_info()